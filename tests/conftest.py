@@ -1,5 +1,6 @@
 import os
 import sys
+import tempfile
 import types
 from pathlib import Path
 
@@ -13,12 +14,16 @@ os.environ.setdefault("DEEPSEEK_API_KEY", "test-deepseek-key")
 os.environ.setdefault("TG_API_ID", "123456")
 os.environ.setdefault("TG_API_HASH", "test-api-hash")
 os.environ.setdefault("TG_SESSION_PATH", str(data_dir / "test_session.session"))
-os.environ.setdefault("DB_PATH", str(data_dir / "test_messages.db"))
+# Keep the test database (and its WAL/SHM sidecars) out of the package tree
+tmp_root = Path(tempfile.mkdtemp(prefix="tonstation-tests-"))
+os.environ.setdefault("DB_PATH", str(tmp_root / "test_messages.db"))
 
-# --- Stub telebot module ---
+# --- Stub classes for telebot / telethon / sidusai ---
 
 
 class _DummyTeleBot:
+    __slots__ = ("sent", "handlers", "stopped")
+
     def __init__(self, *args, **kwargs):
         self.sent = []
         self.handlers = {}
@@ -48,14 +53,9 @@ class _DummyTeleBot:
         self.stopped = True
 
 
-telebot_module = types.ModuleType("telebot")
-telebot_module.TeleBot = _DummyTeleBot
-sys.modules["telebot"] = telebot_module
-
-# --- Stub telethon module ---
-
-
 class _DummyEntity:
+    __slots__ = ("id", "username", "title", "access_hash")
+
     def __init__(self, identifier):
         self.id = 999
         self.username = "dummyuser"
@@ -63,7 +63,17 @@ class _DummyEntity:
         self.access_hash = 111
 
 
+class _DummyInputPeerChannel:
+    __slots__ = ("channel_id", "access_hash")
+
+    def __init__(self, channel_id, access_hash):
+        self.channel_id = channel_id
+        self.access_hash = access_hash
+
+
 class _DummyTelegramClient:
+    __slots__ = ("session", "api_id", "api_hash", "messages")
+
     def __init__(self, session, api_id, api_hash):
         self.session = session
         self.api_id = api_id
@@ -88,36 +98,29 @@ class _DummyTelegramClient:
             yield msg
 
 
-telethon_module = types.ModuleType("telethon")
-telethon_module.TelegramClient = _DummyTelegramClient
-telethon_errors = types.ModuleType("telethon.errors")
-
-
 class _DummyRPCError(Exception):
     pass
 
 
-telethon_errors.RPCError = _DummyRPCError
-telethon_module.errors = telethon_errors
-sys.modules["telethon"] = telethon_module
-sys.modules["telethon.errors"] = telethon_errors
-
-# --- Stub sidusai module for highlight agent ---
-sidusai_module = types.ModuleType("sidusai")
+class _DummyChatAgentValue:
+    __slots__ = ("items",)
 
+    def __init__(self, items=()):
+        self.items = list(items)
 
-class _DummyChatAgentValue(list):
     def append_system(self, content):
-        self.append(("system", content))
+        self.items.append(("system", content))
 
     def append_user(self, content):
-        self.append(("user", content))
+        self.items.append(("user", content))
 
     def last_content(self):
-        return self[-1][1] if self else None
+        return self.items[-1][1] if self.items else None
 
 
 class _DummyCompletedAgentTask:
+    __slots__ = ("agent", "_chat", "_then")
+
     def __init__(self, agent):
         self.agent = agent
         self._chat = None
@@ -133,6 +136,8 @@ class _DummyCompletedAgentTask:
 
 
 class _DummyAgent:
+    __slots__ = ("name", "is_builded", "plugin_applied")
+
     def __init__(self, name):
         self.name = name
         self.is_builded = False
@@ -152,13 +157,9 @@ def _dummy_build_and_register_task_skill_names(skills, agent):
     return ["dummy-skill"]
 
 
-sidusai_core_plugin = types.ModuleType("sidusai.core.plugin")
-sidusai_core_plugin.build_and_register_task_skill_names = _dummy_build_and_register_task_skill_names
-sidusai_core = types.ModuleType("sidusai.core")
-sidusai_core.plugin = sidusai_core_plugin
-
-
 class _DummyDeepSeekPlugin:
+    __slots__ = ("api_key", "model_name")
+
     def __init__(self, api_key, model_name=None):
         self.api_key = api_key
         self.model_name = model_name
@@ -167,37 +168,213 @@ class _DummyDeepSeekPlugin:
         agent.plugin_applied = True
 
 
-sidusai_deepseek = types.ModuleType("sidusai.plugins.deepseek")
-sidusai_deepseek.DeepSeekPlugin = _DummyDeepSeekPlugin
-sidusai_deepseek.skills = types.SimpleNamespace(ds_chat_transform_skill=lambda *_a, **_k: "skill")
-sidusai_plugins = types.ModuleType("sidusai.plugins")
-sidusai_plugins.deepseek = sidusai_deepseek
-
-sidusai_module.CompletedAgentTask = _DummyCompletedAgentTask
-sidusai_module.Agent = _DummyAgent
-sidusai_module.ChatAgentValue = _DummyChatAgentValue
-sidusai_module.core = types.ModuleType("sidusai.core")
-sidusai_module.core.plugin = sidusai_core_plugin
-sidusai_module.plugins = sidusai_plugins
-
-sys.modules["sidusai"] = sidusai_module
-sys.modules["sidusai.core"] = sidusai_module.core
-sys.modules["sidusai.core.plugin"] = sidusai_core_plugin
-sys.modules["sidusai.plugins"] = sidusai_plugins
-sys.modules["sidusai.plugins.deepseek"] = sidusai_deepseek
-
-# Ensure tonstation package is importable with stubs in place
+def _install_stubs():
+    """Register stub telebot / telethon / sidusai modules in sys.modules."""
+    telebot_module = types.ModuleType("telebot")
+    telebot_module.TeleBot = _DummyTeleBot
+    sys.modules["telebot"] = telebot_module
+
+    telethon_module = types.ModuleType("telethon")
+    telethon_module.TelegramClient = _DummyTelegramClient
+    telethon_errors = types.ModuleType("telethon.errors")
+    telethon_errors.RPCError = _DummyRPCError
+    telethon_module.errors = telethon_errors
+    telethon_tl = types.ModuleType("telethon.tl")
+    telethon_types = types.ModuleType("telethon.tl.types")
+    telethon_types.InputPeerChannel = _DummyInputPeerChannel
+    telethon_tl.types = telethon_types
+    telethon_module.tl = telethon_tl
+    sys.modules["telethon"] = telethon_module
+    sys.modules["telethon.errors"] = telethon_errors
+    sys.modules["telethon.tl"] = telethon_tl
+    sys.modules["telethon.tl.types"] = telethon_types
+
+    sidusai_core_plugin = types.ModuleType("sidusai.core.plugin")
+    sidusai_core_plugin.build_and_register_task_skill_names = _dummy_build_and_register_task_skill_names
+    sidusai_core = types.ModuleType("sidusai.core")
+    sidusai_core.plugin = sidusai_core_plugin
+
+    sidusai_deepseek = types.ModuleType("sidusai.plugins.deepseek")
+    sidusai_deepseek.DeepSeekPlugin = _DummyDeepSeekPlugin
+    sidusai_deepseek.skills = types.SimpleNamespace(ds_chat_transform_skill=lambda *_a, **_k: "skill")
+    sidusai_plugins = types.ModuleType("sidusai.plugins")
+    sidusai_plugins.deepseek = sidusai_deepseek
+
+    sidusai_module = types.ModuleType("sidusai")
+    sidusai_module.CompletedAgentTask = _DummyCompletedAgentTask
+    sidusai_module.Agent = _DummyAgent
+    sidusai_module.ChatAgentValue = _DummyChatAgentValue
+    sidusai_module.core = sidusai_core
+    sidusai_module.plugins = sidusai_plugins
+
+    sys.modules["sidusai"] = sidusai_module
+    sys.modules["sidusai.core"] = sidusai_core
+    sys.modules["sidusai.core.plugin"] = sidusai_core_plugin
+    sys.modules["sidusai.plugins"] = sidusai_plugins
+    sys.modules["sidusai.plugins.deepseek"] = sidusai_deepseek
+
+
+# Ensure tonstation package is importable
 sys.path.append(str(repo_root))
 
 # --- Reset config per test to keep env consistent ---
-import pytest
+import asyncio
+import copy
 import importlib
+import shutil
+from datetime import datetime, timezone
+
+import pytest
+
+import tonstation.config as config_mod
+from tonstation.storage import MessageRecord, MessageStore, WindowStats
+
+_SETTINGS = config_mod.settings
+_BASELINE_SETTINGS = copy.deepcopy(_SETTINGS)
+
+
+def pytest_configure(config):
+    # Runs before test modules are collected, i.e. before they import tonstation.cli & co.
+    _install_stubs()
+    config.addinivalue_line(
+        "markers", "reload_config: re-import tonstation.config after the test instead of a field restore"
+    )
 
 
-@pytest.fixture(autouse=True)
-def reload_config_module():
-    import tonstation.config as config_mod
+def pytest_unconfigure(config):
+    shutil.rmtree(tmp_root, ignore_errors=True)
 
-    importlib.reload(config_mod)
+
+@pytest.fixture
+def reload_config_module(request):
     yield
-    importlib.reload(config_mod)
+    if request.node.get_closest_marker("reload_config"):
+        importlib.reload(config_mod)
+        config_mod.settings = _SETTINGS
+    for name, value in vars(_BASELINE_SETTINGS).items():
+        setattr(_SETTINGS, name, value)
+
+
+# --- SQLite fixtures: build the schema once, copy it per test ---
+@pytest.fixture(scope="session")
+def _template_db(tmp_path_factory):
+    path = tmp_path_factory.mktemp("tpl") / "tpl.db"
+    MessageStore(str(path)).close()
+    return path
+
+
+@pytest.fixture
+def fresh_db(tmp_path, _template_db):
+    path = tmp_path / "test.db"
+    shutil.copy(_template_db, path)
+    return path
+
+
+# --- Async helpers: one event loop for the whole session ---
+@pytest.fixture(scope="session")
+def event_loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture
+def run_async(event_loop):
+    return event_loop.run_until_complete
+
+
+# --- Telethon message / client doubles ---
+class _FakeClient:
+    def __init__(self, messages=(), entity=None):
+        self.messages = list(messages)
+        self.entity = entity
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+    async def get_entity(self, identifier):
+        return self.entity
+
+    async def iter_messages(self, identifier, limit=None):
+        for count, msg in enumerate(self.messages):
+            if limit and count >= limit:
+                break
+            yield msg
+
+
+@pytest.fixture
+def now_utc():
+    return datetime.now(timezone.utc)
+
+
+@pytest.fixture
+def make_msg(now_utc):
+    def _make(factory=types.SimpleNamespace, **overrides):
+        fields = dict(
+            id=1,
+            date=now_utc,
+            message="",
+            post_author=None,
+            views=0,
+            forwards=0,
+            replies=None,
+            sender=types.SimpleNamespace(username="u", first_name="U", last_name="u"),
+        )
+        fields.update(overrides)
+        return factory(**fields)
+
+    return _make
+
+
+@pytest.fixture(scope="session")
+def make_client():
+    return _FakeClient
+
+
+# --- Digest fixtures ---
+@pytest.fixture
+def sample_record():
+    return MessageRecord(
+        message_id=1,
+        chat_id="-1001",
+        author="a",
+        full_name="A",
+        date_ts=int(datetime.now(timezone.utc).timestamp()),
+        text="A" * 500,
+        views=10,
+    )
+
+
+@pytest.fixture
+def fake_store():
+    def _make(records):
+        class _FakeStore:
+            def __init__(self, *_a, **_k):
+                self.closed = False
+
+            def fetch_since_days(self, *_a, **_k):
+                return list(records)
+
+            def fetch_top_between_ts(self, _start_ts, _end_ts, limit):
+                from tonstation.digest_builder import pick_top
+
+                return pick_top(list(records), limit)
+
+            def stats_between_ts(self, *_a, **_k):
+                return WindowStats.from_records(records)
+
+            def author_stats(self, *_a, **_k):
+                return []
+
+            def activity_histogram(self, *_a, **_k):
+                return []
+
+            def close(self):
+                self.closed = True
+
+        return _FakeStore
+
+    return _make
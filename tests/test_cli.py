@@ -1,15 +1,23 @@
 import argparse
-import asyncio
 import sys
 from types import SimpleNamespace
-from datetime import datetime, timezone, timedelta
+from datetime import datetime, timedelta, timezone
 
 import pytest
 
 from tonstation import cli, config, storage
 
+_LONG_X = "x" * 300
+_SKIP_BLOB = "skip" * 100
 
-def test_parse_date_and_resolve_range():
+
+def test_parse_date_and_resolve_range(monkeypatch, now_utc):
+    class _FrozenDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return now_utc
+
+    monkeypatch.setattr(cli, "datetime", _FrozenDatetime)
     dt = cli._parse_date("2025-01-01")
     assert dt.tzinfo is not None
 
@@ -19,12 +27,18 @@ def test_parse_date_and_resolve_range():
 
     args2 = SimpleNamespace(from_date=None, to_date=None, days=2)
     start2, end2 = cli._resolve_range(args2)
-    assert (end2 - start2).days == 2
+    assert end2 == now_utc
+    assert end2 - start2 == timedelta(days=2)
+
+    args3 = SimpleNamespace(from_date="2025-01-01", to_date=None)
+    start3, end3 = cli._resolve_range(args3)
+    assert start3 == datetime(2025, 1, 1, tzinfo=timezone.utc)
+    assert end3 == now_utc
 
 
 def test_build_client(monkeypatch):
-    cli.settings.tg_api_id = 1
-    cli.settings.tg_api_hash = "hash"
+    monkeypatch.setattr(cli.settings, "tg_api_id", 1)
+    monkeypatch.setattr(cli.settings, "tg_api_hash", "hash")
     client = cli._build_client()
     assert isinstance(client, cli.TelegramClient)
 
@@ -37,111 +51,104 @@ def test_require_api_credentials(monkeypatch):
     with pytest.raises(ValueError):
         cli._require_api_credentials()
 
-    config.settings.tg_api_id = 123
-    config.settings.tg_api_hash = "hash"
-    cli.settings.tg_api_id = 123
-    cli.settings.tg_api_hash = "hash"
+    monkeypatch.setattr(config.settings, "tg_api_id", 123)
+    monkeypatch.setattr(config.settings, "tg_api_hash", "hash")
+    monkeypatch.setattr(cli.settings, "tg_api_id", 123)
+    monkeypatch.setattr(cli.settings, "tg_api_hash", "hash")
     cli._require_api_credentials()
 
 
-def test_resolve_channel_and_iter_messages(monkeypatch):
-    class _Client(cli.TelegramClient):
-        async def get_entity(self, identifier):
-            return SimpleNamespace(id=42, username="chan", title="Title", access_hash=99)
-
-        def __init__(self, *a, **k):
-            super().__init__(*a, **k)
-            self.messages = []
-
-    monkeypatch.setattr(cli, "TelegramClient", _Client)
-    channel = asyncio.run(cli._resolve_channel(_Client("s", 1, "h"), "chan"))
+def test_resolve_channel_and_iter_messages(now_utc, make_msg, make_client, run_async):
+    entity = SimpleNamespace(id=42, username="chan", title="Title", access_hash=99)
+    channel = run_async(cli._resolve_channel(make_client(entity=entity), "chan"))
     assert channel.chat_id.startswith("-100")
     assert channel.username == "chan"
 
-    msg_time = datetime.now(timezone.utc)
-
-    class _Msg:
-        def __init__(self, idx, text):
-            self.id = idx
-            self.date = msg_time
-            self.message = text
-            self.sender = SimpleNamespace(username=f"user{idx}", first_name="U", last_name=str(idx))
-            self.post_author = None
-            self.views = idx
-            self.forwards = idx + 1
-            self.replies = SimpleNamespace(replies=idx + 2)
-
-    client = _Client("sess", 1, "hash")
-    client.messages = [_Msg(1, "hello world"), _Msg(2, "skip" * 100)]
+    client = make_client([
+        make_msg(
+            id=idx,
+            date=now_utc,
+            message=text,
+            sender=SimpleNamespace(username=f"user{idx}", first_name="U", last_name=str(idx)),
+            views=idx,
+            forwards=idx + 1,
+            replies=SimpleNamespace(replies=idx + 2),
+        )
+        for idx, text in [(1, "hello world"), (2, _SKIP_BLOB)]
+    ])
     ch_record = storage.ChannelRecord(chat_id="-1001", title="T", username="chan", link=None)
-    start = msg_time - timedelta(seconds=1)
-    end = msg_time + timedelta(seconds=1)
+    start = now_utc - timedelta(seconds=1)
+    end = now_utc + timedelta(seconds=1)
     yielded = []
     async def _collect():
         async for rec in cli._iter_messages_for_channel(client, ch_record, start, end, max_messages=1):
             yielded.append(rec)
-    asyncio.run(_collect())
+    run_async(_collect())
     assert len(yielded) == 1
     assert yielded[0].author == "user1"
 
 
-def test_iter_messages_branches(monkeypatch):
-    msg_time = datetime.now(timezone.utc)
-
-    class _Msg:
-        def __init__(self, date, text, sender=None, post_author=None, sender_exception=False):
-            self.id = 1
-            self.date = date
-            self.message = text
-            self._sender = sender
-            self.sender_exception = sender_exception
-            self.post_author = post_author
-            self.views = None
-            self.forwards = None
-            self.replies = None
-        @property
-        def sender(self):
-            if self.sender_exception:
-                raise RuntimeError("no sender")
-            return self._sender
+class _SenderErrorMsg(SimpleNamespace):
+    @property
+    def sender(self):
+        raise RuntimeError("no sender")
+
 
+def test_iter_messages_branches(now_utc, make_msg, make_client, run_async):
     messages = [
         None,
-        _Msg((msg_time + timedelta(seconds=10)).replace(tzinfo=None), "late", sender=None),
-        _Msg(msg_time, None),
-        _Msg(msg_time, "with sender", post_author="fallback", sender_exception=True),
-        _Msg(msg_time - timedelta(seconds=10), "too early"),
+        make_msg(date=(now_utc + timedelta(seconds=10)).replace(tzinfo=None), message="late", sender=None),
+        make_msg(date=now_utc, message=None, sender=None),
+        make_msg(factory=_SenderErrorMsg, date=now_utc, message="with sender", post_author="fallback"),
+        make_msg(date=now_utc - timedelta(seconds=10), message="too early", sender=None),
     ]
 
-    class _Client:
-        def __init__(self, messages):
-            self.messages = messages
-
-        async def iter_messages(self, identifier, limit=None):
-            for m in self.messages:
-                yield m
-
-    start = msg_time - timedelta(seconds=5)
-    end = msg_time + timedelta(seconds=5)
+    start = now_utc - timedelta(seconds=5)
+    end = now_utc + timedelta(seconds=5)
     ch_record = storage.ChannelRecord(chat_id="-1001", title="T", username="chan", link=None)
     collected = []
 
     async def _collect():
-        async for rec in cli._iter_messages_for_channel(_Client(messages), ch_record, start, end, max_messages=None):
+        async for rec in cli._iter_messages_for_channel(make_client(messages), ch_record, start, end, max_messages=None):
             collected.append(rec)
 
-    asyncio.run(_collect())
+    run_async(_collect())
     assert collected and collected[0].author == "fallback"
 
 
-def test_detect_hits_and_format_report():
+def test_channel_peer_prefers_access_hash():
+    peer = cli._channel_peer(storage.ChannelRecord(chat_id="-1001234", username="chan", access_hash=77))
+    assert (peer.channel_id, peer.access_hash) == (1234, 77)
+    assert cli._channel_peer(storage.ChannelRecord(chat_id="-1001234", username="chan")) == "chan"
+    assert cli._channel_peer(storage.ChannelRecord(chat_id="-1001234", link="https://t.me/x")) == "https://t.me/x"
+    assert cli._channel_peer(storage.ChannelRecord(chat_id="-1001234")) == 1234
+
+
+def test_iter_messages_tolerates_missing_fields(now_utc, make_client, run_async):
+    sparse = SimpleNamespace(id=7, date=now_utc, message="sparse", sender=None)
+    ch_record = storage.ChannelRecord(chat_id="-1001", title="T", username="chan", link=None)
+    span = timedelta(seconds=5)
+
+    async def _collect():
+        return [
+            rec
+            async for rec in cli._iter_messages_for_channel(
+                make_client([sparse]), ch_record, now_utc - span, now_utc + span, max_messages=None
+            )
+        ]
+
+    (record,) = run_async(_collect())
+    assert (record.message_id, record.text, record.views, record.replies) == (7, "sparse", None, None)
+
+
+def test_detect_hits_and_format_report(now_utc):
     rec1 = storage.MessageRecord(
         message_id=1,
         chat_id="-1001",
         author="a",
         full_name="A",
-        date_ts=int(datetime.now(timezone.utc).timestamp()),
-        text="ton airdrop " + ("x" * 300),
+        date_ts=int(now_utc.timestamp()),
+        text="ton airdrop " + _LONG_X,
         views=5,
     )
     rec2 = storage.MessageRecord(
@@ -149,7 +156,7 @@ def test_detect_hits_and_format_report():
         chat_id="-1002",
         author="b",
         full_name="B",
-        date_ts=int(datetime.now(timezone.utc).timestamp()),
+        date_ts=int(now_utc.timestamp()),
         text="nothing here",
         views=2,
     )
@@ -160,44 +167,77 @@ def test_detect_hits_and_format_report():
     }
     hits, per_channel, per_tag = cli._detect_hits([rec1, rec2], tags, channels)
     assert len(hits) == 1
+    assert hits[0][1] == ["ton", "airdrop"]
+    assert per_tag == {"ton": [1, 5], "airdrop": [1, 5]}
+    assert per_channel == {"-1001": [1, 5]}
+    mixed_case = storage.MessageRecord(
+        message_id=3, chat_id="-1002", author=None, full_name=None, date_ts=rec2.date_ts, text="New TON Wallet"
+    )
+    mixed_hits, _, _ = cli._detect_hits([mixed_case], [storage.TagRecord(id=3, tag="Ton")], channels)
+    assert mixed_hits[0][1] == ["Ton"]
+    overlapping = [storage.TagRecord(id=i, tag=t) for i, t in enumerate(["ton", "station", "tonstation", "on.", "a+"])]
+    nested = storage.MessageRecord(
+        message_id=4, chat_id="-1002", author=None, full_name=None, date_ts=rec2.date_ts, text="TonStation launch"
+    )
+    nested_hits, _, _ = cli._detect_hits([nested], overlapping, channels)
+    assert nested_hits[0][1] == ["ton", "station", "tonstation"]
+    assert cli._compile_tag_matcher([])("anything") == set()
+    assert cli._compile_tag_matcher(["on.", "a+"])("run on. a+b") == {"on.", "a+"}
     report = cli._format_report(
-        datetime.now(timezone.utc) - timedelta(days=1),
-        datetime.now(timezone.utc),
+        now_utc - timedelta(days=1),
+        now_utc,
         hits,
         per_channel,
         per_tag,
         channels,
     )
     assert "Per channel" in report
+    ranked = {"a": [1, 9], "b": [3, 0], "c": [2, 1], "d": [3, 4]}
+    assert [k for k, _ in cli._ranked(ranked)] == ["b", "d", "c", "a"]
+    assert [k for k, _ in cli._ranked(ranked, top=2)] == ["b", "d"]
+    top_report = cli._format_report(now_utc, now_utc, hits, per_channel, per_tag, channels, top=1)
+    assert "- ton: 1 posts" in top_report and "- airdrop:" not in top_report
     # Empty hits message
-    report2 = cli._format_report(datetime.now(timezone.utc), datetime.now(timezone.utc), [], {}, {}, {})
+    report2 = cli._format_report(now_utc, now_utc, [], {}, {}, {})
     assert "No posts matched" in report2
 
 
-def test_channel_tag_handlers_and_list_output(tmp_path, capsys, monkeypatch):
-    store = storage.MessageStore(str(tmp_path / "cli.db"))
-    args_list = SimpleNamespace(active_only=False)
-    cli._handle_tags_list(SimpleNamespace(), store)
-    assert "No tags stored" in capsys.readouterr().out
-    cli._handle_channels_list(args_list, store)
-    out = capsys.readouterr().out
-    assert "No channels stored" in out
+class _NaiveAutomaton:
+    def __init__(self):
+        self.words = {}
+
+    def add_word(self, word, value):
+        self.words[word] = value
+
+    def make_automaton(self):
+        return None
+
+    def iter(self, text):
+        for word, value in self.words.items():
+            start = text.find(word)
+            while start != -1:
+                yield start + len(word) - 1, value
+                start = text.find(word, start + 1)
+
 
-    class _FakeClient:
-        async def __aenter__(self):
-            return self
+def test_tag_matcher_uses_ahocorasick_when_installed(monkeypatch):
+    monkeypatch.setattr(cli, "ahocorasick", SimpleNamespace(Automaton=_NaiveAutomaton))
+    find_tags = cli._compile_tag_matcher(["ton", "tonstation", "mainnet"])
+    assert find_tags("tonstation launch") == {"ton", "tonstation"}
+    assert find_tags("nothing") == set()
 
-        async def __aexit__(self, exc_type, exc, tb):
-            return False
 
-        async def get_entity(self, identifier):
-            return SimpleNamespace(id=55, username="added", title="Added", access_hash=42)
+def test_channel_tag_handlers_and_list_output(capsys, monkeypatch, make_client, run_async):
+    store = storage.MessageStore(":memory:")
+    args_list = SimpleNamespace(active_only=False)
+    cli._handle_tags_list(SimpleNamespace(), store)
+    cli._handle_channels_list(args_list, store)
 
-    monkeypatch.setattr(cli, "_build_client", lambda: _FakeClient())
+    client = make_client(entity=SimpleNamespace(id=55, username="added", title="Added", access_hash=42))
+    monkeypatch.setattr(cli, "_build_client", lambda: client)
     add_args = SimpleNamespace(identifier="added")
-    asyncio.run(cli._handle_channels_add(add_args, store))
+    run_async(cli._handle_channels_add(add_args, store))
     cli._handle_channels_list(args_list, store)
-    assert "Added" in capsys.readouterr().out
 
     rem_args = SimpleNamespace(identifier="added")
     cli._handle_channels_remove(rem_args, store)
@@ -207,97 +247,108 @@ def test_channel_tag_handlers_and_list_output(tmp_path, capsys, monkeypatch):
     tag_add_args = SimpleNamespace(tag="keyword")
     cli._handle_tags_add(tag_add_args, store)
     cli._handle_tags_list(SimpleNamespace(), store)
-    assert "- keyword" in capsys.readouterr().out
     cli._handle_tags_remove(SimpleNamespace(tag="keyword"), store)
     assert store.list_tags() == []
     store.close()
 
+    no_tags, no_channels, added, keyword = capsys.readouterr().out.splitlines()
+    assert "No tags stored" in no_tags
+    assert "No channels stored" in no_channels
+    assert "Added" in added
+    assert keyword == "- keyword"
+
+
+def _analyze_args(**overrides):
+    args = dict(from_date=None, to_date=None, days=1, top=None, send=False, target=None)
+    args.update(overrides)
+    return SimpleNamespace(**args)
+
+
+@pytest.fixture(scope="module")
+def fetched_store(make_client, event_loop):
+    store = storage.MessageStore(":memory:")
+    store.upsert_channel(storage.ChannelRecord(chat_id="-1001", title="Ch", username="u"))
+    msg = SimpleNamespace(
+        id=1,
+        date=datetime.now(timezone.utc),
+        message="text 1 keyword",
+        sender=SimpleNamespace(username="sender", first_name="First", last_name="Last"),
+        post_author=None,
+        views=3,
+        forwards=0,
+        replies=SimpleNamespace(replies=0),
+    )
+    client = make_client([msg], entity=SimpleNamespace(id=1, username="u", title="Ch", access_hash=1))
+    fetch_args = SimpleNamespace(from_date=None, to_date=None, days=1, max_per_channel=None)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(cli, "_build_client", lambda: client)
+        event_loop.run_until_complete(cli._handle_fetch(fetch_args, store))
+    yield store
+    store.close()
+
 
-def test_handle_fetch_and_analyze(tmp_path, monkeypatch, capsys):
-    store = storage.MessageStore(str(tmp_path / "cli2.db"))
+@pytest.fixture
+def tagged_store(fetched_store):
+    fetched_store.add_tag("keyword")
+    yield fetched_store
+    fetched_store.remove_tag("keyword")
+
+
+@pytest.fixture
+def sent_reports(monkeypatch):
+    calls = []
+    monkeypatch.setattr(cli, "send_digest", lambda bot, chat_id, text: calls.append((chat_id, text)))
+    return calls
+
+
+def test_fetch_requires_channel(run_async):
+    store = storage.MessageStore(":memory:")
     fetch_args = SimpleNamespace(from_date=None, to_date=None, days=1, max_per_channel=None)
     with pytest.raises(ValueError):
-        asyncio.run(cli._handle_fetch(fetch_args, store))
-
-    ch = storage.ChannelRecord(chat_id="-1001", title="Ch", username="u")
-    store.upsert_channel(ch)
-    msg_time = datetime.now(timezone.utc)
-
-    class _Msg:
-        def __init__(self, idx):
-            self.id = idx
-            self.date = msg_time
-            self.message = f"text {idx} keyword"
-            self.sender = SimpleNamespace(username="sender", first_name="First", last_name="Last")
-            self.post_author = None
-            self.views = 3
-            self.forwards = 0
-            self.replies = SimpleNamespace(replies=0)
-
-    class _FakeClient:
-        def __init__(self):
-            self.messages = [_Msg(1)]
-
-        async def __aenter__(self):
-            return self
-
-        async def __aexit__(self, exc_type, exc, tb):
-            return False
-
-        async def get_entity(self, identifier):
-            return SimpleNamespace(id=1, username="u", title="Ch", access_hash=1)
-
-        async def iter_messages(self, identifier, limit=None):
-            for m in self.messages:
-                yield m
-
-    monkeypatch.setattr(cli, "_build_client", lambda: _FakeClient())
-    asyncio.run(cli._handle_fetch(fetch_args, store))
-    assert store.fetch_since_days(1)
-
-    analyze_args = SimpleNamespace(
-        from_date=None,
-        to_date=None,
-        days=1,
-        send=False,
-        target=None,
-    )
-    empty_store = storage.MessageStore(str(tmp_path / "empty.db"))
+        run_async(cli._handle_fetch(fetch_args, store))
+    store.close()
+
+
+def test_fetch_stores_messages(fetched_store):
+    assert fetched_store.fetch_since_days(1)
+
+
+def test_analyze_requires_channels():
+    empty_store = storage.MessageStore(":memory:")
     with pytest.raises(ValueError):
-        cli._handle_analyze(analyze_args, empty_store)
+        cli._handle_analyze(_analyze_args(), empty_store)
     empty_store.close()
 
+
+def test_analyze_requires_tags(fetched_store):
     with pytest.raises(ValueError):
-        cli._handle_analyze(analyze_args, store)
+        cli._handle_analyze(_analyze_args(), fetched_store)
 
-    store.add_tag("keyword")
-    cli._handle_analyze(analyze_args, store)
-    assert "Per channel" in capsys.readouterr().out
 
-    send_calls = []
+def test_analyze_prints_report(tagged_store, capsys):
+    cli._handle_analyze(_analyze_args(), tagged_store)
+    assert "Per channel" in capsys.readouterr().out
 
-    def _fake_send(bot, chat_id, text):
-        send_calls.append((chat_id, text))
 
-    monkeypatch.setattr(cli, "send_digest", _fake_send)
-    analyze_args.send = True
-    analyze_args.target = "target"
-    config.settings.bot_token = None
-    cli.settings.bot_token = None
+def test_analyze_missing_bot_token(tagged_store, sent_reports, monkeypatch):
+    monkeypatch.setattr(cli.settings, "bot_token", None)
     with pytest.raises(ValueError):
-        cli._handle_analyze(analyze_args, store)
+        cli._handle_analyze(_analyze_args(send=True, target="target"), tagged_store)
+    assert sent_reports == []
 
-    config.settings.bot_token = "bot-token"
-    cli.settings.bot_token = "bot-token"
-    analyze_args.target = None
-    cli.settings.target_chat_id = None
+
+def test_analyze_missing_target(tagged_store, sent_reports, monkeypatch):
+    monkeypatch.setattr(cli.settings, "bot_token", "bot-token")
+    monkeypatch.setattr(cli.settings, "target_chat_id", None)
     with pytest.raises(ValueError):
-        cli._handle_analyze(analyze_args, store)
+        cli._handle_analyze(_analyze_args(send=True), tagged_store)
+    assert sent_reports == []
 
-    analyze_args.target = "target"
-    cli._handle_analyze(analyze_args, store)
-    assert send_calls and send_calls[0][0] == "target"
-    store.close()
+
+def test_analyze_sends_to_target(tagged_store, sent_reports, monkeypatch):
+    monkeypatch.setattr(cli.settings, "bot_token", "bot-token")
+    cli._handle_analyze(_analyze_args(send=True, target="target"), tagged_store)
+    assert sent_reports and sent_reports[0][0] == "target"
 
 
 def test_build_parser_and_main(monkeypatch, tmp_path):
@@ -305,7 +356,7 @@ def test_build_parser_and_main(monkeypatch, tmp_path):
     args = parser.parse_args(["tags", "list"])
     assert args.command == "tags" and args.action == "list"
 
-    config.settings.db_path = str(tmp_path / "cli_main.db")
+    monkeypatch.setattr(config.settings, "db_path", str(tmp_path / "cli_main.db"))
     monkeypatch.setattr(sys, "argv", ["prog", "tags", "list"])
     monkeypatch.setattr(cli, "_handle_tags_list", lambda args, store: None)
     cli.main()
@@ -316,12 +367,3 @@ def test_build_parser_and_main(monkeypatch, tmp_path):
     monkeypatch.setattr(sys, "argv", ["prog", "channels", "add", "chan"])
     monkeypatch.setattr(cli, "_handle_channels_add", _fake_add)
     cli.main()
-
-
-def test_cli_main_guard(monkeypatch, tmp_path):
-    import runpy
-    import sys as _sys
-
-    monkeypatch.setattr(_sys, "argv", ["prog", "tags", "list"])
-    monkeypatch.setenv("DB_PATH", str(tmp_path / "cli_guard.db"))
-    runpy.run_module("tonstation.cli", run_name="__main__", alter_sys=True)
@@ -1,4 +1,6 @@
+import collections
 import threading
+from types import SimpleNamespace
 
 import pytest
 
@@ -6,8 +8,9 @@ from tonstation import collector_service
 from tonstation import storage
 
 
-@pytest.fixture(autouse=True)
+@pytest.fixture(autouse=True, scope="module")
 def cleanup_store():
+    # The store opened at import time is swapped out per test; close it once the module is done
     yield
     try:
         collector_service.store.close()
@@ -15,6 +18,20 @@ def cleanup_store():
         pass
 
 
+@pytest.fixture
+def collector_env(fresh_db, monkeypatch):
+    store = storage.MessageStore(str(fresh_db))
+    monkeypatch.setattr(collector_service, "store", store)
+    monkeypatch.setattr(collector_service, "stop_event", threading.Event())
+    monkeypatch.setattr(collector_service, "_pending_records", collections.deque())
+    monkeypatch.setattr(collector_service, "_flush_wakeup", threading.Event())
+    monkeypatch.setattr(collector_service.settings, "source_chat_id", "-1001234567890")
+    monkeypatch.setattr(collector_service.signal, "signal", lambda *a, **k: None)
+    monkeypatch.setattr(collector_service.time, "sleep", lambda *a, **k: None)
+    yield SimpleNamespace(store=store, monkeypatch=monkeypatch)
+    store.close()
+
+
 class _StubChat:
     def __init__(self, chat_id):
         self.id = chat_id
@@ -31,14 +48,7 @@ class _StubMessage:
         self.forward_date = 0
 
 
-def test_handlers_store_messages(tmp_path, monkeypatch):
-    try:
-        collector_service.store.close()
-    except Exception:
-        pass
-    collector_service.store = storage.MessageStore(str(tmp_path / "collector.db"))
-    collector_service.settings.source_chat_id = "-1001234567890"
-
+def test_handlers_store_messages(collector_env):
     assert collector_service._is_source_chat(_StubMessage("other", "x")) is False
     class _NoChat:
         text = "hello"
@@ -58,34 +68,122 @@ def test_handlers_store_messages(tmp_path, monkeypatch):
     normal_msg2 = _StubMessage("-1001234567890", "another", msg_id=3)
     collector_service.handle_text(normal_msg2)
 
-    rows = collector_service.store.fetch_since_days(1)
+    collector_service.flush_pending()
+    rows = collector_env.store.fetch_since_days(1)
     assert len(rows) == 2
-    collector_service.store.close()
 
 
-def test_collector_service_error_import(monkeypatch):
-    import importlib
-    monkeypatch.setattr(collector_service.settings, "bot_token", None)
-    monkeypatch.setattr(collector_service.settings, "source_chat_id", None)
-    import tonstation.config as config_mod
-    monkeypatch.setattr(config_mod.settings, "bot_token", None)
-    monkeypatch.setattr(config_mod.settings, "source_chat_id", None)
-    with pytest.raises(ValueError):
-        importlib.reload(collector_service)
-    # restore valid settings
-    collector_service.settings.bot_token = "test-bot-token"
-    collector_service.settings.source_chat_id = "-1001234567890"
-    importlib.reload(collector_service)
+def test_handlers_flush_in_batches(collector_env):
+    collector_env.monkeypatch.setattr(collector_service, "FLUSH_SIZE", 2)
+
+    collector_service.handle_text(_StubMessage("-1001234567890", "first", msg_id=1))
+    assert collector_env.store.fetch_since_days(1) == []
+    assert not collector_service._flush_wakeup.is_set()
+    collector_service.handle_text(_StubMessage("-1001234567890", "second", msg_id=2))
+    # A full batch wakes the flusher; the handler itself never writes
+    assert collector_service._flush_wakeup.is_set()
+    assert collector_env.store.fetch_since_days(1) == []
+    assert collector_service.flush_pending() == 2
+
+    collector_service.handle_channel_post(_StubMessage("-1001234567890", "third", msg_id=3))
+    assert collector_service.flush_pending() == 1
+    assert collector_service.flush_pending() == 0
+
+
+def test_full_batch_wakes_flush_thread(collector_env):
+    collector_env.monkeypatch.setattr(collector_service, "FLUSH_SIZE", 2)
+    collector_env.monkeypatch.setattr(collector_service, "FLUSH_INTERVAL", 60)
+    flusher = threading.Thread(target=collector_service._flush_loop, daemon=True)
+    flusher.start()
+
+    collector_service.handle_text(_StubMessage("-1001234567890", "first", msg_id=1))
+    collector_service.handle_text(_StubMessage("-1001234567890", "second", msg_id=2))
+    for _ in range(200):
+        if len(collector_env.store.fetch_since_days(1)) == 2:
+            break
+        threading.Event().wait(0.01)
+    assert len(collector_env.store.fetch_since_days(1)) == 2
+
+    collector_service.stop_event.set()
+    collector_service._flush_wakeup.set()
+    flusher.join(timeout=2)
+    assert not flusher.is_alive()
+
+
+def test_flush_loop_backs_off_and_keeps_failed_batches(collector_env):
+    waits = []
+
+    def _wait(delay):
+        waits.append(delay)
+        if len(waits) == 5:
+            collector_service.stop_event.set()
+        return False
+
+    collector_env.monkeypatch.setattr(collector_service, "_flush_wakeup", SimpleNamespace(wait=_wait, clear=lambda: None))
+    collector_service._pending_records.append(
+        storage.message_from_telegram(_StubMessage("-1001234567890", "queued"), "-1001234567890")
+    )
+    real_upsert = collector_env.store.upsert_messages
+    outcomes = [RuntimeError("locked")]
+
+    def _flaky_upsert(batch):
+        if outcomes:
+            raise outcomes.pop()
+        return real_upsert(batch)
+
+    collector_env.monkeypatch.setattr(collector_env.store, "upsert_messages", _flaky_upsert)
+    collector_service._flush_loop()
+
+    assert len(collector_env.store.fetch_since_days(1)) == 1
+    interval = collector_service.FLUSH_INTERVAL
+    assert waits == [interval, interval * 2, interval, interval * 2, interval * 4]
+
+
+def test_flush_pending_writes_outside_the_queue_lock(collector_env):
+    collector_service._pending_records.append(
+        storage.message_from_telegram(_StubMessage("-1001234567890", "queued"), "-1001234567890")
+    )
+    real_upsert = collector_env.store.upsert_messages
+    seen = []
+
+    def _upsert(batch):
+        # A handler can still queue while the write is in progress
+        seen.append(collector_service._pending_lock.acquire(blocking=False))
+        collector_service._pending_lock.release()
+        return real_upsert(batch)
+
+    collector_env.monkeypatch.setattr(collector_env.store, "upsert_messages", _upsert)
+    assert collector_service.flush_pending() == 1
+    assert seen == [True]
+
+
+def test_run_collector_final_flush_failure_still_closes_store(collector_env, caplog):
+    collector_env.monkeypatch.setattr(collector_service.threading, "Thread", lambda *a, **k: _FakeThread(alive=False))
+    collector_service._pending_records.append(
+        storage.message_from_telegram(_StubMessage("-1001234567890", "queued"), "-1001234567890")
+    )
+    closed = []
+    real_close = collector_env.store.close
+    collector_env.monkeypatch.setattr(
+        collector_env.store, "upsert_messages", lambda batch: (_ for _ in ()).throw(RuntimeError("disk full"))
+    )
+    collector_env.monkeypatch.setattr(collector_env.store, "close", lambda: closed.append(True) or real_close())
+
+    collector_service.run_collector()
+    assert closed == [True]
+    assert len(collector_service._pending_records) == 1
+    assert "Final flush failed, 1 queued messages not stored" in caplog.text
 
 
-def test_run_collector_exits_fast(monkeypatch, tmp_path):
-    try:
-        collector_service.store.close()
-    except Exception:
-        pass
-    collector_service.store = storage.MessageStore(str(tmp_path / "collector2.db"))
-    collector_service.stop_event = threading.Event()
+def test_collector_service_error_import():
+    with pytest.raises(ValueError):
+        collector_service._validate_settings(SimpleNamespace(bot_token=None, source_chat_id=None))
+    with pytest.raises(ValueError):
+        collector_service._validate_settings(SimpleNamespace(bot_token="token", source_chat_id=None))
+    collector_service._validate_settings(SimpleNamespace(bot_token="token", source_chat_id="-1001"))
+
 
+def test_run_collector_exits_fast(collector_env):
     state = {"count": 0}
 
     def _fake_polling(**kwargs):
@@ -97,65 +195,43 @@ def test_run_collector_exits_fast(monkeypatch, tmp_path):
         collector_service.stop_event.set()
         raise RuntimeError("stop now")
 
-    collector_service.bot.infinity_polling = _fake_polling
-    collector_service.bot.stop_polling = lambda: None
-    monkeypatch.setattr(collector_service.signal, "signal", lambda *a, **k: None)
-    monkeypatch.setattr(collector_service.time, "sleep", lambda *a, **k: None)
+    collector_env.monkeypatch.setattr(
+        collector_service, "bot", SimpleNamespace(infinity_polling=_fake_polling, stop_polling=lambda: None)
+    )
     collector_service.run_collector()
-
-
-def test_run_collector_keyboardinterrupt(monkeypatch, tmp_path):
-    try:
-        collector_service.store.close()
-    except Exception:
-        pass
-    collector_service.store = storage.MessageStore(str(tmp_path / "collector3.db"))
-    collector_service.stop_event = threading.Event()
-
-    class _FakeThread:
-        def __init__(self, *args, **kwargs):
-            self.join_calls = 0
-
-        def start(self):
-            return None
-
-        def is_alive(self):
-            return True
-
-        def join(self, timeout=None):
-            self.join_calls += 1
-            if self.join_calls == 1:
-                raise KeyboardInterrupt()
-            return None
-
-    monkeypatch.setattr(collector_service.threading, "Thread", lambda *a, **k: _FakeThread())
-    collector_service.bot.infinity_polling = lambda **kwargs: None
-    collector_service.bot.stop_polling = lambda: (_ for _ in ()).throw(RuntimeError("stop"))
-    monkeypatch.setattr(collector_service.signal, "signal", lambda *a, **k: None)
-    monkeypatch.setattr(collector_service.time, "sleep", lambda *a, **k: None)
+    assert state["count"] == 3
+
+
+class _FakeThread:
+    def __init__(self, alive, interrupt=False):
+        self.alive = alive
+        self.interrupt = interrupt
+        self.join_calls = 0
+
+    def start(self):
+        return None
+
+    def is_alive(self):
+        return self.alive
+
+    def join(self, timeout=None):
+        self.join_calls += 1
+        if self.interrupt and self.join_calls == 1:
+            raise KeyboardInterrupt()
+        return None
+
+
+def test_run_collector_keyboardinterrupt(collector_env):
+    thread = _FakeThread(alive=True, interrupt=True)
+    collector_env.monkeypatch.setattr(collector_service.threading, "Thread", lambda *a, **k: thread)
+    collector_env.monkeypatch.setattr(
+        collector_service,
+        "bot",
+        SimpleNamespace(
+            infinity_polling=lambda **kwargs: None,
+            stop_polling=lambda: (_ for _ in ()).throw(RuntimeError("stop")),
+        ),
+    )
     collector_service.run_collector()
-    collector_service.store.close()
-
-
-def test_collector_service_main_guard(monkeypatch, tmp_path):
-    import runpy
-    import threading as real_threading
-
-    class _FakeThread:
-        def __init__(self, *args, **kwargs):
-            pass
-
-        def start(self):
-            return None
-
-        def is_alive(self):
-            return False
-
-        def join(self, timeout=None):
-            return None
-
-    monkeypatch.setenv("DB_PATH", str(tmp_path / "collector_guard.db"))
-    monkeypatch.setattr(real_threading, "Thread", lambda *a, **k: _FakeThread())
-    monkeypatch.setattr(collector_service.signal, "signal", lambda *a, **k: None)
-    monkeypatch.setattr(collector_service.time, "sleep", lambda *a, **k: None)
-    runpy.run_module("tonstation.collector_service", run_name="__main__", alter_sys=True)
+    # The fake stands in for both the polling and the flush thread
+    assert thread.join_calls == 3
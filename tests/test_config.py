@@ -5,6 +5,8 @@ import pytest
 
 from tonstation import config
 
+pytestmark = pytest.mark.usefixtures("reload_config_module")
+
 
 def test_get_env_required_and_cast_errors(monkeypatch):
     with pytest.raises(ValueError):
@@ -15,6 +17,7 @@ def test_get_env_required_and_cast_errors(monkeypatch):
         config._get_env("CAST_BAD", cast=int)
 
 
+@pytest.mark.reload_config
 def test_load_settings_respects_environment(monkeypatch, tmp_path):
     monkeypatch.setenv("TG_BOT_TOKEN", "bot-token-x")
     monkeypatch.setenv("SOURCE_CHAT_ID", "-10042")
@@ -36,6 +39,8 @@ def test_load_env_picks_up_dotenv(monkeypatch, tmp_path):
     env_file = tmp_path / ".env"
     env_file.write_text("DOTENV_TEST_VAR=hello\n")
     monkeypatch.chdir(tmp_path)
-    reloaded = importlib.reload(config)
-    assert reloaded.LOADED_DOTENV == env_file
+    # Register the var so monkeypatch removes whatever load_dotenv sets
+    monkeypatch.setenv("DOTENV_TEST_VAR", "")
+    monkeypatch.delenv("DOTENV_TEST_VAR")
+    assert config._load_env() == env_file
     assert os.getenv("DOTENV_TEST_VAR") == "hello"
@@ -1,9 +1,9 @@
-import importlib
+from functools import lru_cache
 from types import SimpleNamespace
 
 import pytest
 
-from tonstation import config, storage
+from tonstation import config
 
 
 def test_highlight_agent_build_digest_sync():
@@ -14,6 +14,35 @@ def test_highlight_agent_build_digest_sync():
     assert "user prompt" in result
 
 
+def test_highlight_agent_reuses_cached_digest():
+    from tonstation.highlight_agent import WeeklyHighlightAgent
+    from tonstation.storage import MessageStore
+
+    store = MessageStore(":memory:")
+    agent = WeeklyHighlightAgent(api_key="key", system_prompt="sys", model_name="model", cache=store)
+    first = agent.build_digest_sync("user prompt")
+    agent.task_execute = lambda task: pytest.fail("cache miss")
+    assert agent.build_digest_sync("user prompt") == first
+
+    other = WeeklyHighlightAgent(api_key="key", system_prompt="sys", model_name="other", cache=store)
+    assert other._cache_key("user prompt") != agent._cache_key("user prompt")
+    store.close()
+
+
+def test_highlight_agent_batch_keeps_prompt_order():
+    import asyncio
+
+    from tonstation.highlight_agent import WeeklyHighlightAgent
+
+    agent = WeeklyHighlightAgent(api_key="key", system_prompt="sys", model_name="model")
+    results = asyncio.run(agent.build_digests_batch(["one", "two", "three"], max_concurrency=2))
+    assert [("one" in r, "two" in r, "three" in r) for r in results] == [
+        (True, False, False),
+        (False, True, False),
+        (False, False, True),
+    ]
+
+
 def test_highlight_agent_timeout(monkeypatch):
     from tonstation.highlight_agent import WeeklyHighlightAgent
 
@@ -23,22 +52,59 @@ def test_highlight_agent_timeout(monkeypatch):
         agent.build_digest_sync("late", timeout=0)
 
 
-def test_digest_prompt_scoring_and_sending(monkeypatch):
-    from tonstation import digest_builder
+def test_highlight_agent_late_completion_after_timeout():
+    import threading
 
-    rec = storage.MessageRecord(
-        message_id=1,
-        chat_id="-1001",
-        author="alice",
-        full_name="Alice",
-        date_ts=int(storage.datetime.now(storage.timezone.utc).timestamp()),
-        text="A" * 500,
-        views=10,
-    )
+    from tonstation.highlight_agent import WeeklyHighlightAgent
+
+    agent = WeeklyHighlightAgent(api_key="key", system_prompt="sys", model_name="model")
+    pending = []
+    agent.task_execute = pending.append
+    with pytest.raises(TimeoutError):
+        agent.build_digest_sync("late", timeout=0)
+
+    # The plugin finishes on its own thread after asyncio.run closed the loop
+    errors = []
+    worker = threading.Thread(target=lambda: errors.extend(_call_safely(pending[0]._then, pending[0]._chat)))
+    worker.start()
+    worker.join()
+    assert errors == []
+
+
+def _call_safely(fn, *args):
+    try:
+        fn(*args)
+    except Exception as exc:  # pragma: no cover - only on regression
+        return [exc]
+    return []
+
+
+def test_highlight_agent_sync_inside_running_loop():
+    import asyncio
+
+    from tonstation.highlight_agent import WeeklyHighlightAgent
+
+    agent = WeeklyHighlightAgent(api_key="key", system_prompt="sys", model_name="model")
+
+    async def _caller():
+        return agent.build_digest_sync("from a loop")
+
+    assert "from a loop" in asyncio.run(_caller())
+
+
+def test_digest_prompt_scoring_and_sending(monkeypatch, fake_store, sample_record):
+    from tonstation import digest_builder
 
     assert "No messages" in digest_builder.build_prompt([], 7)
-    prompt = digest_builder.build_prompt([rec], 3)
+    prompt = digest_builder.build_prompt([sample_record], 3)
     assert "Window:" in prompt and "Top messages:" in prompt
+    stats = digest_builder.WindowStats.from_records([sample_record])
+    assert digest_builder.render_prompt([sample_record], stats, 3) == prompt
+    enriched = digest_builder.render_prompt(
+        [sample_record], stats, 3, top_authors=[(None, "Ann", 4, 10)], activity=[(86400, 4)]
+    )
+    assert "Top authors: @Ann (4 msgs, 10 views)\n" in enriched
+    assert "Daily activity: 1970-01-02: 4\n" in enriched
 
     bot = SimpleNamespace(sent=[])
 
@@ -50,17 +116,7 @@ def test_digest_prompt_scoring_and_sending(monkeypatch):
     assert len(bot.sent) == 2
 
     # Patch MessageStore to return a fixed set of records
-    class _FakeStore:
-        def __init__(self, *_a, **_k):
-            self.closed = False
-
-        def fetch_since_days(self, *_a, **_k):
-            return [rec]
-
-        def close(self):
-            self.closed = True
-
-    monkeypatch.setattr(digest_builder, "MessageStore", _FakeStore)
+    monkeypatch.setattr(digest_builder, "MessageStore", fake_store([sample_record]))
     monkeypatch.setattr(
         digest_builder.WeeklyHighlightAgent,
         "build_digest_sync",
@@ -71,10 +127,9 @@ def test_digest_prompt_scoring_and_sending(monkeypatch):
     assert "digest text" in output
 
     # send=True with target uses bot send
-    original_token = config.settings.bot_token
-    config.settings.bot_token = "bot-token"
-    digest_builder.settings.bot_token = "bot-token"
-    digest_builder.settings.target_chat_id = "target-chat"
+    monkeypatch.setattr(config.settings, "bot_token", "bot-token")
+    monkeypatch.setattr(digest_builder.settings, "bot_token", "bot-token")
+    monkeypatch.setattr(digest_builder.settings, "target_chat_id", "target-chat")
     sent_messages = []
 
     class _Bot:
@@ -85,31 +140,80 @@ def test_digest_prompt_scoring_and_sending(monkeypatch):
             sent_messages.append((chat_id, text))
 
     monkeypatch.setattr(digest_builder.telebot, "TeleBot", lambda *a, **k: _Bot())
+    # Fresh bot cache for this test so the patched TeleBot is the one built
+    monkeypatch.setattr(digest_builder, "get_bot", lru_cache(maxsize=4)(digest_builder.get_bot.__wrapped__))
     result = digest_builder.build_and_optionally_send(send=True, target_chat_id="target")
     assert "digest text" in result
     assert sent_messages and sent_messages[0][0] == "target"
+    assert digest_builder.get_bot("bot-token") is digest_builder.get_bot("bot-token")
 
     # send=True but missing target falls back to print
-    digest_builder.settings.target_chat_id = None
+    monkeypatch.setattr(digest_builder.settings, "target_chat_id", None)
     result2 = digest_builder.build_and_optionally_send(send=True, target_chat_id=None)
     assert "digest text" in result2
 
-    config.settings.bot_token = original_token
-    digest_builder.settings.bot_token = original_token
+
+def test_build_and_send_with_real_store(monkeypatch, tmp_path, sample_record):
+    from dataclasses import replace
+
+    from tonstation import digest_builder
+    from tonstation.storage import MessageStore
+
+    db_path = str(tmp_path / "digest.db")
+    store = MessageStore(db_path)
+    store.upsert_messages([
+        sample_record,
+        replace(sample_record, message_id=2, text="short", views=3),
+        replace(sample_record, message_id=3, author="b"),
+    ])
+    store.close()
+
+    monkeypatch.setattr(digest_builder.settings, "db_path", db_path)
+    prompts = []
+    monkeypatch.setattr(
+        digest_builder.WeeklyHighlightAgent,
+        "build_digest_sync",
+        lambda self, prompt, timeout=120: prompts.append(prompt) or "digest text",
+    )
+    assert digest_builder.build_and_optionally_send(send=False) == "digest text"
+    (prompt,) = prompts
+    assert "Messages: 3 | Unique authors: 2" in prompt
+    assert "Top authors: @a (2 msgs, 13 views), @b (1 msgs, 10 views)\n" in prompt
+    assert f"Daily activity: {sample_record.day}: 3\n" in prompt
+
+
+def test_format_record_flattens_and_truncates(sample_record):
+    from dataclasses import replace
+
+    from tonstation import digest_builder
+
+    short = replace(sample_record, text="line one\r\nline\ttwo")
+    assert "line one  line two (views=10)" in digest_builder.format_record(short, 1)
+    long_line = digest_builder.format_record(replace(sample_record, text="y" * 319 + "\n" + "z" * 50), 2)
+    assert long_line.endswith(": " + "y" * 319 + "... (views=10)")
+
+
+def test_pick_top_matches_full_sort(sample_record):
+    from dataclasses import replace
+
+    from tonstation import digest_builder
+
+    records = [replace(sample_record, message_id=i, views=views) for i, views in enumerate([3, 9, 3, 0, 9, 1])]
+    expected = sorted(records, key=digest_builder._score, reverse=True)[:4]
+    assert digest_builder.pick_top(records, 4) == expected
+    assert [r.message_id for r in expected] == [1, 4, 0, 2]
+    assert digest_builder.pick_top(records, 0) == []
 
 
 def test_digest_builder_missing_key(monkeypatch):
     import tonstation.digest_builder as db
-    original_key = config.settings.deepseek_api_key
-    config.settings.deepseek_api_key = None
-    db.settings.deepseek_api_key = None
+    monkeypatch.setattr(config.settings, "deepseek_api_key", None)
+    monkeypatch.setattr(db.settings, "deepseek_api_key", None)
     with pytest.raises(ValueError):
         db.build_and_optionally_send(send=False)
-    config.settings.deepseek_api_key = original_key
-    db.settings.deepseek_api_key = original_key
 
 
-def test_digest_builder_errors_and_entry(monkeypatch):
+def test_digest_builder_errors_and_entry(monkeypatch, fake_store, sample_record):
     import tonstation.digest_builder as db
     monkeypatch.setattr(db, "settings", SimpleNamespace(
         deepseek_api_key="key",
@@ -121,21 +225,7 @@ def test_digest_builder_errors_and_entry(monkeypatch):
         top_n_messages=5,
     ))
 
-    class _Store:
-        def __init__(self, *_a, **_k):
-            pass
-
-        def fetch_since_days(self, *_a, **_k):
-            return [storage.MessageRecord(
-                message_id=1,
-                chat_id="-1001",
-                author="a",
-                full_name="A",
-                date_ts=int(storage.datetime.now(storage.timezone.utc).timestamp()),
-                text="hello",
-            )]
-
-    monkeypatch.setattr(db, "MessageStore", _Store)
+    monkeypatch.setattr(db, "MessageStore", fake_store([sample_record]))
     monkeypatch.setattr(
         db.WeeklyHighlightAgent,
         "build_digest_sync",
@@ -150,8 +240,3 @@ def test_digest_builder_errors_and_entry(monkeypatch):
     monkeypatch.setattr(sys, "argv", ["prog", "--no-send"])
     db.main()
     assert calls and calls[0][0] is False
-
-    import runpy
-    monkeypatch.setattr(sys, "argv", ["prog", "--no-send"])
-    monkeypatch.setattr(db, "MessageStore", _Store)
-    runpy.run_module("tonstation.digest_builder", run_name="__main__", alter_sys=True)
@@ -22,12 +22,3 @@ def test_run_highlight_main(monkeypatch):
     monkeypatch.setattr(sys, "argv", ["prog", "--target", "tgt"])
     run_highlight.main()
     assert calls[-1] == (True, "tgt")
-
-
-def test_run_highlight_guard(monkeypatch):
-    import runpy
-    import sys
-    import tonstation.digest_builder as db
-    monkeypatch.setattr(sys, "argv", ["prog", "--print-only"])
-    monkeypatch.setattr(db, "build_and_optionally_send", lambda *a, **k: "ok")
-    runpy.run_module("tonstation.run_highlight", run_name="__main__", alter_sys=True)
@@ -1,3 +1,4 @@
+import sqlite3
 from datetime import datetime, timedelta, timezone
 
 import pytest
@@ -91,6 +92,364 @@ def test_message_store_crud(tmp_path):
     store.close()
 
 
+def test_upsert_messages_batches_and_skips_empty():
+    store = storage.MessageStore(":memory:")
+    records = [
+        storage.MessageRecord(message_id=i, chat_id="c", author=None, full_name=None, date_ts=_ts(), text=text)
+        for i, text in enumerate(["one", "  ", "two", "three"])
+    ]
+    assert store.upsert_messages(records) == 3
+    assert store.upsert_messages([]) == 0
+    assert [r.text for r in store.fetch_since_days(1)] == ["one", "two", "three"]
+    store.close()
+
+
+def test_iter_between_reads_across_fetch_batches(monkeypatch):
+    monkeypatch.setattr(storage, "_FETCH_BATCH", 2)
+    store = storage.MessageStore(":memory:")
+    store.upsert_messages(
+        storage.MessageRecord(message_id=i, chat_id="c", author=None, full_name=None, date_ts=_ts(i - 10), text=f"m{i}")
+        for i in range(5)
+    )
+    assert [r.message_id for r in store.fetch_since_days(1)] == [0, 1, 2, 3, 4]
+    assert type(store._execute_tuples("SELECT 1", ()).fetchone()) is tuple
+    assert store._read.execute("SELECT 1 AS one").fetchone()["one"] == 1
+    store.close()
+
+
+def test_author_stats_and_activity_histogram():
+    store = storage.MessageStore(":memory:")
+    day = 86400
+    base = (_ts() // day - 2) * day
+    rows = [
+        ("c1", "alice", base + 10, 5),
+        ("c1", "alice", base + day + 10, None),
+        ("c2", "bob", base + day + 20, 7),
+        ("c1", None, base + day + 30, 1),
+    ]
+    store.upsert_messages(
+        storage.MessageRecord(message_id=i, chat_id=chat, author=author, full_name=None, date_ts=ts, text="t", views=views)
+        for i, (chat, author, ts, views) in enumerate(rows)
+    )
+    start, end = base, _ts()
+    assert store.author_stats(start, end, limit=2) == [("alice", None, 2, 5), ("bob", None, 1, 7)]
+    assert store.author_stats(start, end, chat_ids=["c2"]) == [("bob", None, 1, 7)]
+    assert store.activity_histogram(start, end) == [(base, 1), (base + day, 3)]
+    assert store.activity_histogram(start, end, chat_ids=["c1"]) == [(base, 1), (base + day, 2)]
+    store.close()
+
+
+def test_upsert_updates_in_place_and_ignores_stale():
+    store = storage.MessageStore(":memory:")
+    now = _ts()
+    rec = storage.MessageRecord(message_id=1, chat_id="c", author=None, full_name=None, date_ts=now, text="v1", views=1)
+    store.upsert_message(rec)
+    row_id = store.conn.execute("SELECT id FROM messages").fetchone()[0]
+
+    rec.text, rec.views = "v2", 5
+    assert store.upsert_messages([rec]) == 1
+    rec.date_ts, rec.text = now - 60, "stale"
+    assert store.upsert_messages([rec]) == 0
+
+    row = store.conn.execute("SELECT id, text, views FROM messages").fetchone()
+    assert tuple(row) == (row_id, "v2", 5)
+    store.close()
+
+
+def test_message_store_connection_pragmas(tmp_path):
+    store = storage.MessageStore(str(tmp_path / "pragmas.db"))
+    expected = {
+        "journal_mode": "wal",
+        "synchronous": 1,
+        "temp_store": 2,
+        "cache_size": -65536,
+        "wal_autocheckpoint": 1000,
+        "busy_timeout": 5000,
+    }
+    for name, value in expected.items():
+        assert store.conn.execute(f"PRAGMA {name}").fetchone()[0] == value
+    store.close()
+
+
+def test_fetch_between_uses_chat_date_index():
+    store = storage.MessageStore(":memory:")
+    window_sql = storage._window_sql(True)
+    assert storage._window_sql(True) is window_sql
+    plan = store.conn.execute("EXPLAIN QUERY PLAN " + window_sql, (0, 1, '["a", "b"]')).fetchall()
+    assert any("USING INDEX idx_messages_chat_date" in row[3] for row in plan)
+    indexes = {row[0] for row in store.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert "idx_messages_chat" not in indexes
+    store.close()
+
+
+def test_fetch_top_and_stats_match_python_scoring():
+    from tonstation import digest_builder
+
+    store = storage.MessageStore(":memory:")
+    samples = [(None, "Ann", 3, 100), ("bob", None, 9, 10), ("", "", None, 700), ("bob", "B", 3, 260), (None, None, 0, 1200)]
+    for i, (author, full_name, views, length) in enumerate(samples):
+        store.upsert_message(
+            storage.MessageRecord(
+                message_id=i, chat_id="c", author=author, full_name=full_name,
+                date_ts=_ts(-100 + i), text="x" * length, views=views,
+            )
+        )
+    store.upsert_message(
+        storage.MessageRecord(message_id=99, chat_id="c", author="old", full_name=None, date_ts=_ts(-10 * 86400), text="old", views=50)
+    )
+    records = store.fetch_since_days(7)
+    window = storage.since_days_range(7)
+    now = datetime.now(tz=timezone.utc)
+    rows = store.iter_between(now - timedelta(days=7), now)
+    assert iter(rows) is rows
+    assert list(rows) == records
+
+    # Includes the two records tied on score
+    assert store.fetch_top_between_ts(*window, 5) == digest_builder.pick_top(records, 5)
+    assert store.fetch_top_between_ts(*window, 2) == digest_builder.pick_top(records, 2)
+    assert store.stats_between_ts(*window) == storage.WindowStats.from_records(records)
+    assert store.stats_between_ts(*window).authors == 3
+    assert store.stats_between_ts(*storage.since_days_range(0)) == storage.WindowStats(count=0, authors=0)
+    store.close()
+
+
+def test_reads_use_read_only_connection(tmp_path):
+    store = storage.MessageStore(str(tmp_path / "split.db"))
+    assert store._read is not store.conn
+    with pytest.raises(sqlite3.OperationalError):
+        store._read.execute("INSERT INTO tags (tag) VALUES ('x')")
+
+    store.add_tag("ton")
+    store.conn.execute("BEGIN IMMEDIATE")
+    store.conn.execute("INSERT INTO tags (tag) VALUES ('pending')")
+    # WAL readers see the last committed state while the writer holds its lock
+    assert [t.tag for t in store.list_tags()] == ["ton"]
+    store.conn.rollback()
+    store.close()
+
+
+def test_find_channel_by_id_username_or_link():
+    store = storage.MessageStore(":memory:")
+    store.upsert_channel(storage.ChannelRecord(chat_id="-1001", username="alpha", link="https://t.me/alpha", added_at=1))
+    store.upsert_channel(storage.ChannelRecord(chat_id="-1002", username="beta", added_at=2))
+    assert store.find_channel("-1002").username == "beta"
+    assert store.find_channel("@alpha").chat_id == "-1001"
+    assert store.find_channel("https://t.me/alpha").chat_id == "-1001"
+    assert store.find_channel("gamma") is None
+    plan = store.conn.execute(
+        "EXPLAIN QUERY PLAN SELECT chat_id FROM channels WHERE chat_id = ? OR username = ? OR link = ?",
+        ("x", "x", "x"),
+    ).fetchall()
+    assert any("idx_channels_username" in row[3] for row in plan)
+    store.close()
+
+
+def test_fetch_matching_uses_fts_and_stays_in_sync(tmp_path):
+    db_path = tmp_path / "fts.db"
+    store = storage.MessageStore(str(db_path))
+    assert store.has_fts
+    now = _ts()
+
+    def _rec(message_id, text, chat_id="c1"):
+        return storage.MessageRecord(message_id=message_id, chat_id=chat_id, author=None, full_name=None, date_ts=now, text=text)
+
+    store.upsert_messages([_rec(1, "New TON wallet"), _rec(2, "tonstation mainnet"), _rec(3, "nothing"), _rec(4, "ton", "c2")])
+    window = (datetime.now(tz=timezone.utc) - timedelta(days=1), datetime.now(tz=timezone.utc) + timedelta(minutes=1))
+    assert [r.message_id for r in store.fetch_matching(*window, ["ton"], chat_ids=["c1"])] == [1, 2]
+    assert [r.message_id for r in store.fetch_matching(*window, ['mainnet', 'no"pe'])] == [2]
+
+    # Edits replace the indexed text
+    store.upsert_message(_rec(1, "edited post"))
+    assert [r.message_id for r in store.fetch_matching(*window, ["ton"], chat_ids=["c1"])] == [2]
+    # Tags shorter than a trigram fall back to a byte-level scan of the window
+    assert [r.message_id for r in store.fetch_matching(*window, ["ON"])] == [2, 4]
+    assert len(store.fetch_matching(*window, ["тон"])) == 4
+    assert [r.message_id for r in store.search_tag("on", *window)] == [2, 4]
+    assert [r.message_id for r in store.search_tag("TON", *window, chat_ids=["c2"])] == [4]
+    store.close()
+
+    # A database created before the FTS table gets its existing rows indexed
+    store = storage.MessageStore(str(db_path))
+    with store.conn:
+        store.conn.execute("DROP TABLE messages_fts")
+    store.close()
+    store = storage.MessageStore(str(db_path))
+    assert [r.message_id for r in store.fetch_matching(*window, ["mainnet"])] == [2]
+    store.close()
+
+
+def test_bytes_prefilter_keeps_every_exact_match():
+    store = storage.MessageStore(":memory:")
+    texts = ["Привет TON", "nothing here", "\u212aelvin", "\u0130stanbul", "plain ton"]
+    store.upsert_messages(
+        storage.MessageRecord(message_id=i, chat_id="c", author=None, full_name=None, date_ts=_ts(-i), text=text)
+        for i, text in enumerate(texts)
+    )
+    window = (datetime.now(tz=timezone.utc) - timedelta(days=1), datetime.now(tz=timezone.utc))
+    store.has_fts = False
+    for tag in ("ton", "k", "i", "zz"):
+        expected = [r.text for r in store.fetch_between(*window) if r.matches_tag(tag)]
+        assert [r.text for r in store.fetch_matching(*window, [tag]) if r.matches_tag(tag)] == expected
+    assert [r.text for r in store.fetch_matching(*window, ["ton"])] == ["plain ton", "\u0130stanbul", "\u212aelvin", "Привет TON"]
+    store.close()
+
+
+def test_record_day_matches_date():
+    for ts in (0, 86399, 86400, 1_700_000_000, -1):
+        rec = storage.MessageRecord(message_id=1, chat_id="c", author=None, full_name=None, date_ts=ts, text="t")
+        assert rec.day == rec.date.strftime("%Y-%m-%d")
+    # Records are slotted: no per-instance __dict__
+    assert not hasattr(rec, "__dict__")
+
+
+def test_text_lower_cache_and_any_tag_in():
+    rec = storage.MessageRecord(message_id=1, chat_id="c", author=None, full_name=None, date_ts=0, text="New TON Wallet")
+    assert rec.text_lower == "new ton wallet"
+    assert rec.text_lower is rec.text_lower
+    assert storage.any_tag_in(rec, ("airdrop", "wallet"))
+    assert not storage.any_tag_in(rec, ())
+    rec.text = "Airdrop"
+    assert rec.text_lower == "airdrop" and rec.matches_tag("AIRDROP")
+    assert rec == storage.MessageRecord(message_id=1, chat_id="c", author=None, full_name=None, date_ts=0, text="Airdrop")
+
+
+def test_migrates_autoincrement_messages_table(tmp_path):
+    db_path = tmp_path / "legacy.db"
+    legacy = sqlite3.connect(db_path)
+    legacy.execute(
+        """
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER NOT NULL, chat_id TEXT NOT NULL,
+            author TEXT, full_name TEXT, date_ts INTEGER NOT NULL, text TEXT NOT NULL,
+            views INTEGER, forwards INTEGER, replies INTEGER, UNIQUE(chat_id, message_id)
+        )
+        """
+    )
+    legacy.execute(
+        "INSERT INTO messages (id, message_id, chat_id, date_ts, text) VALUES (42, 1, 'c', ?, 'legacy airdrop')",
+        (_ts(),),
+    )
+    legacy.commit()
+    legacy.close()
+
+    store = storage.MessageStore(str(db_path))
+    table_sql = store.conn.execute("SELECT sql FROM sqlite_master WHERE name = 'messages'").fetchone()[0]
+    assert "AUTOINCREMENT" not in table_sql.upper()
+    assert store.conn.execute("SELECT id FROM messages").fetchone()[0] == 42
+    now = datetime.now(tz=timezone.utc)
+    assert [r.text for r in store.fetch_matching(now - timedelta(days=1), now, ["airdrop"])] == ["legacy airdrop"]
+    store.close()
+
+
+def test_schema_bootstrap_runs_once_per_version(tmp_path):
+    db_path = str(tmp_path / "versioned.db")
+    store = storage.MessageStore(db_path)
+    assert store.conn.execute("PRAGMA user_version").fetchone()[0] == storage._SCHEMA_VERSION
+    with store.conn:
+        store.conn.execute("DROP INDEX idx_channels_link")
+    store.close()
+
+    # Already at the current version: no DDL runs on open
+    store = storage.MessageStore(db_path)
+    assert store.has_fts
+    names = {row[0] for row in store.conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert "idx_channels_link" not in names
+    store.close()
+
+
+def test_failed_autoincrement_migration_rolls_back(tmp_path):
+    db_path = tmp_path / "legacy_dupes.db"
+    legacy = sqlite3.connect(db_path)
+    # No UNIQUE(chat_id, message_id) here, so the copy into the new table fails on the duplicate
+    legacy.execute(
+        """
+        CREATE TABLE messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, message_id INTEGER NOT NULL, chat_id TEXT NOT NULL,
+            author TEXT, full_name TEXT, date_ts INTEGER NOT NULL, text TEXT NOT NULL,
+            views INTEGER, forwards INTEGER, replies INTEGER
+        )
+        """
+    )
+    legacy.executemany(
+        "INSERT INTO messages (message_id, chat_id, date_ts, text) VALUES (1, 'c', ?, 'dup')", [(_ts(),), (_ts(),)]
+    )
+    legacy.commit()
+    legacy.close()
+
+    with pytest.raises(sqlite3.IntegrityError):
+        storage.MessageStore(str(db_path))
+    check = sqlite3.connect(db_path)
+    tables = {row[0] for row in check.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert "messages_new" not in tables
+    assert check.execute("SELECT COUNT(*) FROM messages").fetchone()[0] == 2
+    check.close()
+
+
+def test_channel_and_tag_caches_invalidate_on_write():
+    store = storage.MessageStore(":memory:")
+    store.upsert_channel(storage.ChannelRecord(chat_id="-1001", title="Old", added_at=1))
+    first = store.get_channel("-1001")
+    first.title = "Mutated"
+    listed = store.list_channels()
+    listed[0].title = "Mutated"
+    assert store.get_channel("-1001").title == "Old"
+    assert store.list_channels()[0].title == "Old"
+    assert [c.title for c in store.list_channels(active_only=True)] == ["Old"]
+
+    store.upsert_channel(storage.ChannelRecord(chat_id="-1001", title="New", added_at=1, is_active=False))
+    assert store.get_channel("-1001").title == "New"
+    assert store.list_channels(active_only=True) == []
+    store.remove_channel("-1001")
+    assert store.get_channel("-1001") is None and store.list_channels() == []
+
+    store.add_tag("ton")
+    tags = store.list_tags()
+    tags.clear()
+    assert [t.tag for t in store.list_tags()] == ["ton"]
+    store.add_tag("airdrop")
+    assert [t.tag for t in store.list_tags()] == ["airdrop", "ton"]
+    store.remove_tag("ton")
+    assert [t.tag for t in store.list_tags()] == ["airdrop"]
+    store.close()
+
+
+def test_add_tags_returns_records_for_new_and_existing():
+    store = storage.MessageStore(":memory:")
+    existing = store.add_tag("ton")
+    records = store.add_tags([" Airdrop ", "TON", "nft"])
+    assert [r.tag for r in records] == ["airdrop", "ton", "nft"]
+    assert records[1].id == existing.id
+    assert [t.tag for t in store.list_tags()] == ["airdrop", "nft", "ton"]
+
+    with pytest.raises(ValueError):
+        store.add_tags(["ok", " "])
+    assert len(store.list_tags()) == 3
+    store.close()
+
+
+def test_digest_cache_roundtrip_and_ttl():
+    store = storage.MessageStore(":memory:")
+    assert store.get_cached_digest("k") is None
+    store.cache_digest("k", "digest")
+    assert store.get_cached_digest("k", max_age=60) == "digest"
+    store.cache_digest("k", "newer")
+    assert store.get_cached_digest("k") == "newer"
+
+    store.conn.execute("UPDATE digest_cache SET created_ts = created_ts - 120")
+    assert store.get_cached_digest("k", max_age=60) is None
+    assert store.conn.execute("SELECT COUNT(*) FROM digest_cache").fetchone()[0] == 0
+    store.close()
+
+
+def test_message_store_in_memory(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = storage.MessageStore(":memory:")
+    store.add_tag("ton")
+    assert [t.tag for t in store.list_tags()] == ["ton"]
+    store.close()
+    assert list(tmp_path.iterdir()) == []
+
+
 def test_build_message_link_variants():
     link = storage.build_message_link("-1001", 10, channel_username="chanuser")
     assert link == "https://t.me/chanuser/10"
@@ -101,6 +460,17 @@ def test_build_message_link_variants():
     link3 = storage.build_message_link("-10012345", 12)
     assert link3 == "https://t.me/c/12345/12"
 
+    channel = storage.ChannelRecord(chat_id="-10012345", link="https://t.me/custom/")
+    assert channel.message_link(13) == storage.build_message_link("-10012345", 13, channel_link=channel.link)
+    channel.link = None
+    channel.username = "chanuser"
+    assert channel.message_link(14) == "https://t.me/chanuser/14"
+
+    store = storage.MessageStore(":memory:")
+    store.upsert_channel(storage.ChannelRecord(chat_id="-1001", link="https://t.me/custom/"))
+    assert store.get_channel("-1001").link == "https://t.me/custom"
+    store.close()
+
 
 def test_message_from_telegram_builds_record():
     class _User:
@@ -124,7 +494,7 @@ def test_message_from_telegram_builds_record():
     assert rec.views == 7
 
 
-def test_storage_edge_cases(tmp_path, monkeypatch):
+def test_storage_edge_cases(tmp_path, monkeypatch, now_utc):
     # Create store with missing parent directory to hit mkdir path
     db_path = tmp_path / "nested" / "db.sqlite"
     store = storage.MessageStore(str(db_path))
@@ -136,7 +506,7 @@ def test_storage_edge_cases(tmp_path, monkeypatch):
         chat_id="c",
         author=None,
         full_name=None,
-        date_ts=int(storage.datetime.now(storage.timezone.utc).timestamp()),
+        date_ts=int(now_utc.timestamp()),
         text="content",
     )
     assert rec.matches_tag("") is False
@@ -1,15 +1,24 @@
 import argparse
 import asyncio
+import heapq
+import io
 import logging
+import operator
+import re
 from datetime import datetime, timedelta, timezone
 from typing import Dict, Iterable, List, Optional, Sequence, Tuple
 
-import telebot
 from telethon import TelegramClient
 from telethon.errors import RPCError
+from telethon.tl.types import InputPeerChannel
+
+try:
+    import ahocorasick
+except ImportError:  # optional: falls back to a compiled regex
+    ahocorasick = None
 
 from tonstation.config import settings
-from tonstation.digest_builder import send_digest
+from tonstation.digest_builder import NL_TAB, get_bot, send_digest
 from tonstation.storage import (
     ChannelRecord,
     MessageRecord,
@@ -21,6 +30,12 @@ from tonstation.storage import (
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Messages buffered per channel before they are written in one transaction
+FETCH_BATCH_SIZE = 500
+
+_MESSAGE_FIELDS = ('id', 'message', 'views', 'forwards', 'post_author', 'replies')
+_message_fields = operator.attrgetter(*_MESSAGE_FIELDS)
+
 
 # ----------- Date helpers -----------
 def _parse_date(value: str) -> datetime:
@@ -71,6 +86,17 @@ async def _resolve_channel(client: TelegramClient, identifier: str) -> ChannelRe
     )
 
 
+def _channel_peer(channel: ChannelRecord):
+    """
+    Peer to pass to Telethon for a stored channel.
+    """
+    # A stored access_hash lets Telethon skip resolving the username on every run
+    if channel.access_hash:
+        return InputPeerChannel(int(channel.chat_id.removeprefix('-100')), channel.access_hash)
+    # Otherwise resolve by username/link; fall back to numeric id
+    return channel.username or channel.link or int(channel.chat_id.replace('-100', ''))
+
+
 async def _iter_messages_for_channel(
     client: TelegramClient,
     channel: ChannelRecord,
@@ -81,21 +107,29 @@ async def _iter_messages_for_channel(
     """
     Yield MessageRecords for a channel between start/end (UTC).
     """
-    # Prefer resolving by username/link; fall back to numeric id
-    identifier = channel.username or channel.link or int(channel.chat_id.replace('-100', ''))
+    identifier = _channel_peer(channel)
     processed = 0
+    # Compare POSIX timestamps; aware datetimes need no astimezone() for that
+    start_ts = start.timestamp()
+    end_ts = end.timestamp()
     async for msg in client.iter_messages(identifier, limit=max_messages):
         if msg is None:
             continue
         msg_dt = msg.date
         if msg_dt.tzinfo is None:
             msg_dt = msg_dt.replace(tzinfo=timezone.utc)
-        msg_dt = msg_dt.astimezone(timezone.utc)
-        if msg_dt > end:
+        msg_ts = msg_dt.timestamp()
+        if msg_ts > end_ts:
             continue
-        if msg_dt < start:
+        if msg_ts < start_ts:
             break
-        text = msg.message
+        try:
+            msg_id, text, views, forwards, post_author, replies_obj = _message_fields(msg)
+        except AttributeError:
+            # Service messages lack some of the post fields
+            msg_id, text, views, forwards, post_author, replies_obj = (
+                getattr(msg, name, None) for name in _MESSAGE_FIELDS
+            )
         if text is None or str(text).strip() == '':
             continue
         author = None
@@ -105,24 +139,22 @@ async def _iter_messages_for_channel(
         except Exception:
             sender = None
         if sender:
+            # Channel senders have no first/last name, so keep the defaults here
             author = getattr(sender, 'username', None)
             first = getattr(sender, 'first_name', None)
             last = getattr(sender, 'last_name', None)
             full_name = ' '.join([p for p in [first, last] if p])
         if not author:
-            author = getattr(msg, 'post_author', None)
-        views = getattr(msg, 'views', None)
-        forwards = getattr(msg, 'forwards', None)
+            author = post_author
         replies = None
-        replies_obj = getattr(msg, 'replies', None)
         if replies_obj is not None:
             replies = getattr(replies_obj, 'replies', None)
         yield MessageRecord(
-            message_id=msg.id,
+            message_id=msg_id,
             chat_id=channel.chat_id,
             author=author,
             full_name=full_name,
-            date_ts=int(msg_dt.timestamp()),
+            date_ts=int(msg_ts),
             text=str(text).strip(),
             views=views,
             forwards=forwards,
@@ -134,71 +166,128 @@ async def _iter_messages_for_channel(
 
 
 # ----------- Analytics helpers -----------
+def _compile_tag_matcher(tags_lower: Sequence[str]):
+    """
+    Return a function mapping lowercased text to the set of tags it contains.
+
+    All tags are found in one pass per text (an Aho-Corasick automaton when pyahocorasick is
+    installed, otherwise one regex) instead of one substring search per tag.
+    """
+    unique = sorted(set(tags_lower), key=len, reverse=True)
+    if not unique:
+        return lambda _text: set()
+    if ahocorasick is not None:
+        # The automaton reports every occurrence, overlaps included, in a single pass
+        automaton = ahocorasick.Automaton()
+        for tag in unique:
+            automaton.add_word(tag, tag)
+        automaton.make_automaton()
+        iterate = automaton.iter
+        return lambda text_lower: {tag for _, tag in iterate(text_lower)}
+    # The lookahead reports the longest tag starting at every position, overlaps included
+    finditer = re.compile('(?=(' + '|'.join(map(re.escape, unique)) + '))').finditer
+    # A shorter tag hidden inside a reported one is present too
+    contained = {tag: {other for other in unique if other in tag} for tag in unique}
+
+    def _find(text_lower: str) -> set:
+        found = set()
+        for match in finditer(text_lower):
+            tag = match.group(1)
+            if tag not in found:
+                found |= contained[tag]
+        return found
+
+    return _find
+
+
 def _detect_hits(
-    records: Sequence[MessageRecord],
+    records: Iterable[MessageRecord],
     tags: Sequence[TagRecord],
     channels_by_id: Dict[str, ChannelRecord],
 ):
     hits = []
-    per_channel: Dict[str, Dict[str, int]] = {}
-    per_tag: Dict[str, Dict[str, int]] = {}
+    # Buckets are [count, views] lists; indexing is cheaper than string keys
+    per_channel: Dict[str, List[int]] = {}
+    per_tag: Dict[str, List[int]] = {}
+    per_channel_get = per_channel.get
+    per_tag_get = per_tag.get
+    channels_get = channels_by_id.get
+    append_hit = hits.append
+    # Lowercase each tag once instead of once per record
+    tag_pairs = [(tag.tag, tag.tag.lower()) for tag in tags if tag.tag]
+    find_tags = _compile_tag_matcher([low for _, low in tag_pairs])
     for rec in records:
-        matched_tags = [tag.tag for tag in tags if rec.matches_tag(tag.tag)]
+        found = find_tags(rec.text_lower)
+        if not found:
+            continue
+        matched_tags = [orig for orig, low in tag_pairs if low in found]
         if not matched_tags:
             continue
-        channel = channels_by_id.get(rec.chat_id)
+        views = rec.views or 0
         for tag in matched_tags:
-            bucket = per_tag.setdefault(tag, {'count': 0, 'views': 0})
-            bucket['count'] += 1
-            bucket['views'] += rec.views or 0
-        chan_bucket = per_channel.setdefault(rec.chat_id, {'count': 0, 'views': 0})
-        chan_bucket['count'] += 1
-        chan_bucket['views'] += rec.views or 0
-        hits.append((rec, matched_tags, channel))
+            bucket = per_tag_get(tag)
+            if bucket is None:
+                bucket = per_tag[tag] = [0, 0]
+            bucket[0] += 1
+            bucket[1] += views
+        chan_bucket = per_channel_get(rec.chat_id)
+        if chan_bucket is None:
+            chan_bucket = per_channel[rec.chat_id] = [0, 0]
+        chan_bucket[0] += 1
+        chan_bucket[1] += views
+        append_hit((rec, matched_tags, channels_get(rec.chat_id)))
     return hits, per_channel, per_tag
 
 
+def _bucket_count(item) -> int:
+    return item[1][0]
+
+
+def _ranked(buckets: Dict[str, List[int]], top: Optional[int] = None):
+    """
+    Buckets by descending hit count; with `top`, only the first `top` are selected.
+    """
+    if top is None:
+        return sorted(buckets.items(), key=_bucket_count, reverse=True)
+    return heapq.nlargest(top, buckets.items(), key=_bucket_count)
+
+
 def _format_report(
     start: datetime,
     end: datetime,
     hits,
-    per_channel: Dict[str, Dict[str, int]],
-    per_tag: Dict[str, Dict[str, int]],
+    per_channel: Dict[str, List[int]],
+    per_tag: Dict[str, List[int]],
     channels_by_id: Dict[str, ChannelRecord],
+    top: Optional[int] = None,
 ) -> str:
-    lines: List[str] = []
-    lines.append(f"Analytics window: {start:%Y-%m-%d %H:%M} UTC -> {end:%Y-%m-%d %H:%M} UTC")
-    lines.append(f"Total hits: {len(hits)} | Channels with hits: {len(per_channel)} | Tags matched: {len(per_tag)}")
+    buf = io.StringIO()
+    w = buf.write
+    w(f"Analytics window: {start:%Y-%m-%d %H:%M} UTC -> {end:%Y-%m-%d %H:%M} UTC")
+    w(f"\nTotal hits: {len(hits)} | Channels with hits: {len(per_channel)} | Tags matched: {len(per_tag)}")
     if per_channel:
-        lines.append("\nPer channel:")
-        for chat_id, stats in sorted(per_channel.items(), key=lambda kv: kv[1]['count'], reverse=True):
+        w("\n\nPer channel:")
+        for chat_id, (count, views) in _ranked(per_channel, top):
             channel = channels_by_id.get(chat_id)
             name = channel.title or channel.username or chat_id
-            lines.append(f"- {name}: {stats['count']} posts, reach={stats['views']}")
+            w(f"\n- {name}: {count} posts, reach={views}")
     if per_tag:
-        lines.append("\nPer tag:")
-        for tag, stats in sorted(per_tag.items(), key=lambda kv: kv[1]['count'], reverse=True):
-            lines.append(f"- {tag}: {stats['count']} posts, reach={stats['views']}")
+        w("\n\nPer tag:")
+        for tag, (count, views) in _ranked(per_tag, top):
+            w(f"\n- {tag}: {count} posts, reach={views}")
     if hits:
-        lines.append("\nMatched posts:")
+        w("\n\nMatched posts:")
         for rec, tags, channel in hits:
             ch_name = channel.title or channel.username or rec.chat_id if channel else rec.chat_id
-            link = build_message_link(
-                rec.chat_id,
-                rec.message_id,
-                channel_username=channel.username if channel else None,
-                channel_link=channel.link if channel else None,
-            )
-            snippet = rec.text.replace('\n', ' ')
-            if len(snippet) > 240:
-                snippet = snippet[:240].rstrip() + "..."
+            link = channel.message_link(rec.message_id) if channel else build_message_link(rec.chat_id, rec.message_id)
+            snippet = rec.text[:240].translate(NL_TAB)
+            if len(rec.text) > 240:
+                snippet = snippet.rstrip() + "..."
             view_text = f"views={rec.views}" if rec.views is not None else "views=n/a"
-            lines.append(
-                f"- {ch_name} [{rec.date:%Y-%m-%d}] tags={', '.join(tags)} ({view_text}) -> {link}\n  {snippet}"
-            )
+            w(f"\n- {ch_name} [{rec.day}] tags={', '.join(tags)} ({view_text}) -> {link}\n  {snippet}")
     if not hits:
-        lines.append("\nNo posts matched the current tag list in this window.")
-    return "\n".join(lines)
+        w("\n\nNo posts matched the current tag list in this window.")
+    return buf.getvalue()
 
 
 # ----------- Command handlers -----------
@@ -212,16 +301,10 @@ async def _handle_channels_add(args, store: MessageStore):
 
 def _handle_channels_remove(args, store: MessageStore):
     identifier = args.identifier
-    channels = store.list_channels()
-    to_remove = None
-    ident_norm = identifier.replace('@', '')
-    for ch in channels:
-        if ch.chat_id == identifier or ch.username == ident_norm or ch.link == identifier:
-            to_remove = ch.chat_id
-            break
-    if not to_remove:
+    channel = store.find_channel(identifier)
+    if not channel:
         raise ValueError(f"Channel '{identifier}' not found in local list.")
-    store.remove_channel(to_remove)
+    store.remove_channel(channel.chat_id)
     logger.info("Removed channel %s", identifier)
 
 
@@ -266,9 +349,13 @@ async def _handle_fetch(args, store: MessageStore):
         for ch in channels:
             logger.info("Fetching %s", ch.title or ch.username or ch.chat_id)
             count = 0
+            batch: List[MessageRecord] = []
             async for record in _iter_messages_for_channel(client, ch, start, end, max_msgs):
-                store.upsert_message(record)
-                count += 1
+                batch.append(record)
+                if len(batch) >= FETCH_BATCH_SIZE:
+                    count += store.upsert_messages(batch)
+                    batch = []
+            count += store.upsert_messages(batch)
             logger.info("Stored %s messages for %s", count, ch.chat_id)
 
 
@@ -281,17 +368,18 @@ def _handle_analyze(args, store: MessageStore):
         raise ValueError("No tags configured. Add tags first via `tags add`.")
     start, end = _resolve_range(args)
     channel_ids = [ch.chat_id for ch in channels]
-    records = store.fetch_between(start, end, chat_ids=channel_ids)
+    # The FTS index narrows the window to candidate posts; _detect_hits confirms each tag
+    records = store.iter_matching(start, end, [t.tag for t in tags], chat_ids=channel_ids)
     channels_by_id = {c.chat_id: c for c in channels}
     hits, per_channel, per_tag = _detect_hits(records, tags, channels_by_id)
-    report = _format_report(start, end, hits, per_channel, per_tag, channels_by_id)
+    report = _format_report(start, end, hits, per_channel, per_tag, channels_by_id, top=args.top)
     if args.send:
         if not settings.bot_token:
             raise ValueError("TG_BOT_TOKEN is required to send analytics to Telegram.")
         target = args.target or settings.target_chat_id
         if not target:
             raise ValueError("Target chat id is not set. Use --target or HIGHLIGHT_TARGET_CHAT_ID.")
-        bot = telebot.TeleBot(settings.bot_token, parse_mode=None)
+        bot = get_bot(settings.bot_token)
         send_digest(bot, target, report)
         logger.info("Analytics report sent to %s", target)
     else:
@@ -346,6 +434,7 @@ def build_parser() -> argparse.ArgumentParser:
     analyze.add_argument("--from", dest="from_date", help="Start datetime (ISO, e.g., 2025-01-01)")
     analyze.add_argument("--to", dest="to_date", help="End datetime (ISO). Defaults to now.")
     analyze.add_argument("--days", type=int, default=settings.window_days, help="Window size in days if no explicit dates are given")
+    analyze.add_argument("--top", type=int, default=None, help="Only list the N channels and tags with the most hits")
     analyze.add_argument("--send", action="store_true", help="Send analytics to Telegram instead of printing")
     analyze.add_argument("--target", type=str, default=None, help="Override target chat id for sending")
     analyze.set_defaults(func=_handle_analyze)
@@ -366,5 +455,5 @@ def main():
         store.close()
 
 
-if __name__ == "__main__":
+if __name__ == "__main__":  # pragma: no cover
     main()
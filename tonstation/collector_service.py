@@ -1,3 +1,4 @@
+import collections
 import logging
 import signal
 import threading
@@ -11,13 +12,71 @@ from tonstation.storage import MessageStore, message_from_telegram
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-if not settings.bot_token or not settings.source_chat_id:
-    raise ValueError('TG_BOT_TOKEN and SOURCE_CHAT_ID are required to run the collector service.')
 
+def _validate_settings(settings):
+    if not settings.bot_token or not settings.source_chat_id:
+        raise ValueError('TG_BOT_TOKEN and SOURCE_CHAT_ID are required to run the collector service.')
+
+
+_validate_settings(settings)
 bot = telebot.TeleBot(settings.bot_token, parse_mode=None, threaded=False)
 store = MessageStore(settings.db_path)
 stop_event = threading.Event()
 
+# Incoming posts are buffered and written in batches by a background flusher
+FLUSH_SIZE = 50
+FLUSH_INTERVAL = 0.2
+FLUSH_IDLE_MAX = 2.0
+_pending_records = collections.deque()
+# _pending_lock only guards the queue, so handlers never wait on SQLite;
+# _write_lock serializes the writes themselves on the shared store
+_pending_lock = threading.Lock()
+_write_lock = threading.Lock()
+# Set when a full batch is queued (or on shutdown) so the flusher writes it without waiting out its delay
+_flush_wakeup = threading.Event()
+
+
+def flush_pending() -> int:
+    with _write_lock:
+        with _pending_lock:
+            if not _pending_records:
+                return 0
+            batch = list(_pending_records)
+            _pending_records.clear()
+        try:
+            stored = store.upsert_messages(batch)
+        except Exception:
+            # Put the batch back ahead of anything queued meanwhile so the next flush retries it
+            with _pending_lock:
+                _pending_records.extendleft(reversed(batch))
+            raise
+    logger.info('Stored %s messages', stored)
+    return stored
+
+
+def _queue_record(record):
+    with _pending_lock:
+        _pending_records.append(record)
+        due = len(_pending_records) >= FLUSH_SIZE
+    if due:
+        _flush_wakeup.set()
+
+
+def _flush_loop():
+    delay = FLUSH_INTERVAL
+    while True:
+        _flush_wakeup.wait(delay)
+        _flush_wakeup.clear()
+        if stop_event.is_set():
+            return
+        try:
+            flushed = flush_pending()
+        except Exception as exc:
+            logger.exception('Flushing queued messages failed, will retry: %s', exc)
+            flushed = 0
+        # Back off while idle; return to the short interval once posts arrive
+        delay = FLUSH_INTERVAL if flushed else min(delay * 2, FLUSH_IDLE_MAX)
+
 
 def _is_source_chat(message) -> bool:
     try:
@@ -40,8 +99,8 @@ def handle_channel_post(message):
         return
     record = message_from_telegram(message, settings.source_chat_id)
     if record:
-        store.upsert_message(record)
-        logger.info('Stored channel post %s', record.message_id)
+        logger.info('Received channel post %s', record.message_id)
+        _queue_record(record)
 
 
 @bot.message_handler(content_types=['text'])
@@ -53,8 +112,8 @@ def handle_text(message):
         return
     record = message_from_telegram(message, settings.source_chat_id)
     if record:
-        store.upsert_message(record)
-        logger.info('Stored message %s', record.message_id)
+        logger.info('Received message %s', record.message_id)
+        _queue_record(record)
 
 
 def run_collector():
@@ -94,6 +153,8 @@ def run_collector():
 
     polling_thread = threading.Thread(target=_polling_loop, daemon=True)
     polling_thread.start()
+    flush_thread = threading.Thread(target=_flush_loop, daemon=True)
+    flush_thread.start()
 
     try:
         while polling_thread.is_alive():
@@ -102,10 +163,17 @@ def run_collector():
         _shutdown()
     finally:
         _shutdown()
+        _flush_wakeup.set()
         polling_thread.join(timeout=5)
-        store.close()
-        logger.info('Collector stopped.')
+        flush_thread.join(timeout=5)
+        try:
+            flush_pending()
+        except Exception as exc:
+            logger.exception('Final flush failed, %s queued messages not stored: %s', len(_pending_records), exc)
+        finally:
+            store.close()
+            logger.info('Collector stopped.')
 
 
-if __name__ == '__main__':
+if __name__ == '__main__':  # pragma: no cover
     run_collector()
@@ -1,17 +1,22 @@
 import argparse
+import heapq
 import logging
 from datetime import datetime, timedelta, timezone
-from typing import List, Tuple
+from functools import lru_cache
+from typing import List, Optional, Sequence, Tuple
 
 import telebot
 
 from tonstation.config import settings
 from tonstation.highlight_agent import DEFAULT_SYSTEM_PROMPT, WeeklyHighlightAgent
-from tonstation.storage import MessageRecord, MessageStore
+from tonstation.storage import MessageRecord, MessageStore, WindowStats, since_days_range
 
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Line breaks and tabs collapse to single spaces in one-line snippets
+NL_TAB = str.maketrans({'\n': ' ', '\t': ' ', '\r': ' '})
+
 
 def _score(record: MessageRecord) -> int:
     views = record.views or 0
@@ -20,41 +25,68 @@ def _score(record: MessageRecord) -> int:
 
 
 def pick_top(records: List[MessageRecord], limit: int) -> List[MessageRecord]:
-    scored = sorted(records, key=_score, reverse=True)
-    return scored[:limit]
+    # Same result as sorted(...)[:limit], ties included, without sorting everything
+    return heapq.nlargest(limit, records, key=_score)
 
 
 def format_record(record: MessageRecord, idx: int) -> str:
-    text = record.text.replace('\n', ' ')
-    if len(text) > 320:
-        text = text[:320].rstrip() + '...'
+    # Slice first so only the kept prefix is copied; translate keeps the length
+    text = record.text[:320].translate(NL_TAB)
+    if len(record.text) > 320:
+        text = text.rstrip() + '...'
     author = record.author or record.full_name or 'anon'
     stats = []
     if record.views is not None:
         stats.append(f'views={record.views}')
-    stamp = record.date.strftime('%Y-%m-%d')
+    stamp = record.day
     return f"{idx}. [{stamp}] @{author}: {text} ({', '.join(stats) if stats else 'stats=n/a'})"
 
 
 def build_prompt(records: List[MessageRecord], window_days: int) -> str:
-    if not records:
+    return render_prompt(pick_top(records, settings.top_n_messages), WindowStats.from_records(records), window_days)
+
+
+def render_prompt(
+    top_records: List[MessageRecord],
+    stats: WindowStats,
+    window_days: int,
+    top_authors: Optional[Sequence[Tuple[Optional[str], Optional[str], int, int]]] = None,
+    activity: Optional[Sequence[Tuple[int, int]]] = None,
+) -> str:
+    if not stats.count:
         return "No messages were captured in the selected window. Produce a short empty-state note."
 
-    top_records = pick_top(records, settings.top_n_messages)
-    authors = {r.author or r.full_name or 'anon' for r in records}
-    start = records[0].date.strftime('%Y-%m-%d')
-    end = records[-1].date.strftime('%Y-%m-%d')
-    stats = (
+    start = datetime.fromtimestamp(stats.first_ts, tz=timezone.utc).strftime('%Y-%m-%d')
+    end = datetime.fromtimestamp(stats.last_ts, tz=timezone.utc).strftime('%Y-%m-%d')
+    header = (
         f"Window: {start} to {end} UTC ({window_days} days)\n"
-        f"Messages: {len(records)} | Unique authors: {len(authors)} | "
+        f"Messages: {stats.count} | Unique authors: {stats.authors} | "
         f"Top sample size: {len(top_records)}\n"
     )
+    if top_authors:
+        header += 'Top authors: ' + ', '.join(
+            f"@{author or full_name or 'anon'} ({count} msgs, {views} views)"
+            for author, full_name, count, views in top_authors
+        ) + '\n'
+    if activity:
+        header += 'Daily activity: ' + ', '.join(
+            f"{datetime.fromtimestamp(bucket, tz=timezone.utc).strftime('%Y-%m-%d')}: {count}"
+            for bucket, count in activity
+        ) + '\n'
     formatted = '\n'.join([format_record(r, idx + 1) for idx, r in enumerate(top_records)])
     instructions = (
         "Use ONLY the provided messages. Do not invent data. "
         "If metrics are missing, skip them. Keep Markdown concise."
     )
-    return f"{stats}\nTop messages:\n{formatted}\n\n{instructions}"
+    return f"{header}\nTop messages:\n{formatted}\n\n{instructions}"
+
+
+@lru_cache(maxsize=4)
+def get_bot(token: str) -> telebot.TeleBot:
+    """
+    Shared sender bot per token, so repeated sends in one process reuse its HTTP session.
+    """
+    return telebot.TeleBot(token, parse_mode=None)
 
 
 def send_digest(bot: telebot.TeleBot, chat_id: str, text: str):
@@ -81,14 +113,20 @@ def build_and_optionally_send(send: bool = True, target_chat_id: str | None = No
 
     store = MessageStore(settings.db_path)
     try:
-        records = store.fetch_since_days(settings.window_days)
-        logger.info('Loaded %s messages for last %s days', len(records), settings.window_days)
-
-        prompt = build_prompt(records, settings.window_days)
+        # Scoring and the window aggregates run in SQL over one window; only the top records reach Python
+        start_ts, end_ts = since_days_range(settings.window_days)
+        stats = store.stats_between_ts(start_ts, end_ts)
+        top_records = store.fetch_top_between_ts(start_ts, end_ts, settings.top_n_messages)
+        top_authors = store.author_stats(start_ts, end_ts)
+        activity = store.activity_histogram(start_ts, end_ts)
+        logger.info('Loaded %s messages for last %s days', stats.count, settings.window_days)
+
+        prompt = render_prompt(top_records, stats, settings.window_days, top_authors, activity)
         agent = WeeklyHighlightAgent(
             api_key=settings.deepseek_api_key,
             system_prompt=DEFAULT_SYSTEM_PROMPT,
             model_name=settings.model_name,
+            cache=store,
         )
         digest_text = agent.build_digest_sync(prompt)
 
@@ -96,7 +134,7 @@ def build_and_optionally_send(send: bool = True, target_chat_id: str | None = No
         if send and target:
             if not settings.bot_token:
                 raise ValueError('TG_BOT_TOKEN is required to send the digest to Telegram.')
-            bot = telebot.TeleBot(settings.bot_token, parse_mode=None)
+            bot = get_bot(settings.bot_token)
             send_digest(bot, target, digest_text)
             logger.info('Digest sent to %s', target)
         elif send and not target:
@@ -116,5 +154,5 @@ def main():
     build_and_optionally_send(send=not args.no_send)
 
 
-if __name__ == '__main__':
+if __name__ == '__main__':  # pragma: no cover
     main()
@@ -1,4 +1,7 @@
-import threading
+import asyncio
+import concurrent.futures
+import hashlib
+from typing import List
 
 import sidusai as sai
 import sidusai.core.plugin as _cp
@@ -14,9 +17,13 @@ class WeeklyHighlightAgent(sai.Agent):
     SidusAI agent that uses DeepSeek to generate the weekly digest.
     """
 
-    def __init__(self, api_key: str, system_prompt: str, model_name: str = None):
+    def __init__(self, api_key: str, system_prompt: str, model_name: str = None, cache=None, cache_ttl: int = 86400):
         super().__init__('tonstation_highlight_agent')
         self.system_prompt = system_prompt
+        self.model_name = model_name
+        # Optional digest cache (MessageStore); identical prompts reuse the stored reply within cache_ttl seconds
+        self.cache = cache
+        self.cache_ttl = cache_ttl
 
         plugin = ds.DeepSeekPlugin(api_key=api_key, model_name=model_name)
         plugin.apply_plugin(self)
@@ -28,17 +35,47 @@ class WeeklyHighlightAgent(sai.Agent):
 
     def build_digest_sync(self, user_prompt: str, timeout: int = 120) -> str:
         """
-        Build digest synchronously by waiting for the task completion.
+        Build digest synchronously; thin wrapper over build_digest_async.
+
+        asyncio.run cannot nest, so a caller already inside an event loop gets the digest built
+        on a worker thread with its own loop (that caller's loop is blocked until it finishes).
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.build_digest_async(user_prompt, timeout=timeout))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as pool:
+            return pool.submit(asyncio.run, self.build_digest_async(user_prompt, timeout=timeout)).result()
+
+    async def build_digest_async(self, user_prompt: str, timeout: int = 120) -> str:
+        """
+        Build digest by awaiting the task completion instead of blocking a thread.
         """
+        key = self._cache_key(user_prompt)
+        if self.cache is not None:
+            cached = self.cache.get_cached_digest(key, max_age=self.cache_ttl)
+            if cached is not None:
+                return cached
+
         if not self.is_builded:
             self.application_build()
 
-        latch = threading.Event()
-        result = {'text': None}
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _resolve(text):
+            if not future.done():
+                future.set_result(text)
 
         def _handler(chat: sai.ChatAgentValue):
-            result['text'] = chat.last_content()
-            latch.set()
+            # The plugin may complete the task on its own thread, possibly after a timeout
+            # abandoned the future and asyncio.run closed the loop
+            if future.done() or loop.is_closed():
+                return
+            try:
+                loop.call_soon_threadsafe(_resolve, chat.last_content())
+            except RuntimeError:
+                pass
 
         chat = sai.ChatAgentValue([])
         chat.append_system(self.system_prompt)
@@ -46,10 +83,33 @@ class WeeklyHighlightAgent(sai.Agent):
 
         task = WeeklyHighlightTask(self).data(chat).then(_handler)
         self.task_execute(task)
-        latch.wait(timeout=timeout)
-        if not latch.is_set():
-            raise TimeoutError('Digest generation timed out')
-        return result['text'] or ''
+        try:
+            text = await asyncio.wait_for(future, timeout=timeout)
+        except asyncio.TimeoutError:
+            future.cancel()
+            raise TimeoutError('Digest generation timed out') from None
+        text = text or ''
+        if text and self.cache is not None:
+            self.cache.cache_digest(key, text)
+        return text
+
+    async def build_digests_batch(self, prompts: List[str], timeout: int = 120, max_concurrency: int = 8) -> List[str]:
+        """
+        Build several digests concurrently, at most `max_concurrency` in flight. Results keep prompt order.
+        """
+        if not self.is_builded:
+            self.application_build()
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def _one(prompt: str) -> str:
+            async with semaphore:
+                return await self.build_digest_async(prompt, timeout=timeout)
+
+        return list(await asyncio.gather(*(_one(p) for p in prompts)))
+
+    def _cache_key(self, user_prompt: str) -> str:
+        payload = f"{self.system_prompt}\n{user_prompt}\n{self.model_name or ''}"
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
 
 
 DEFAULT_SYSTEM_PROMPT = (
@@ -29,5 +29,5 @@ def main():
     build_and_optionally_send(send=send, target_chat_id=args.target)
 
 
-if __name__ == '__main__':
+if __name__ == '__main__':  # pragma: no cover
     main()
@@ -1,11 +1,24 @@
+import json
 import sqlite3
-from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
+import time
+from dataclasses import dataclass, field, replace
+from functools import lru_cache
+from datetime import datetime, timezone
 from pathlib import Path
-from typing import Iterable, List, Optional, Sequence
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
 
 
-@dataclass
+@lru_cache(maxsize=1024)
+def _norm_tag(tag: str) -> str:
+    return tag.lower()
+
+
+@lru_cache(maxsize=4096)
+def _utc_day_label(day: int) -> str:
+    return datetime.fromtimestamp(day * 86400, tz=timezone.utc).strftime('%Y-%m-%d')
+
+
+@dataclass(slots=True)
 class MessageRecord:
     message_id: int
     chat_id: str
@@ -16,21 +29,65 @@ class MessageRecord:
     views: Optional[int] = None
     forwards: Optional[int] = None
     replies: Optional[int] = None
+    # (text, text.lower()) for the text it was computed from
+    _lower_cache: Optional[Tuple[str, str]] = field(default=None, init=False, repr=False, compare=False)
+
+    @property
+    def text_lower(self) -> str:
+        """
+        Lowercased text, computed once per record and recomputed only if `text` changes.
+        """
+        text = self.text or ''
+        cached = self._lower_cache
+        if cached is None or cached[0] is not text:
+            cached = self._lower_cache = (text, text.lower())
+        return cached[1]
 
     @property
     def date(self) -> datetime:
         return datetime.fromtimestamp(self.date_ts, tz=timezone.utc)
 
+    @property
+    def day(self) -> str:
+        """
+        UTC calendar date as YYYY-MM-DD, cached per day rather than built per record.
+        """
+        return _utc_day_label(int(self.date_ts) // 86400)
+
     def matches_tag(self, tag: str) -> bool:
         """
         Case-insensitive substring check for a tag/keyword.
         """
         if not tag:
             return False
-        return tag.lower() in (self.text or '').lower()
+        return _norm_tag(tag) in self.text_lower
 
 
-@dataclass
+def any_tag_in(record: MessageRecord, tags_lower: Tuple[str, ...]) -> bool:
+    """
+    True if the record contains any of the already-lowercased tags.
+    """
+    text = record.text_lower
+    return any(tag in text for tag in tags_lower)
+
+
+@dataclass(slots=True)
+class WindowStats:
+    count: int
+    authors: int
+    first_ts: Optional[int] = None
+    last_ts: Optional[int] = None
+
+    @classmethod
+    def from_records(cls, records: Sequence[MessageRecord]) -> 'WindowStats':
+        if not records:
+            return cls(count=0, authors=0)
+        authors = {r.author or r.full_name or 'anon' for r in records}
+        stamps = [r.date_ts for r in records]
+        return cls(count=len(records), authors=len(authors), first_ts=min(stamps), last_ts=max(stamps))
+
+
+@dataclass(slots=True)
 class ChannelRecord:
     chat_id: str
     title: Optional[str] = None
@@ -39,42 +96,198 @@ class ChannelRecord:
     access_hash: Optional[int] = None
     added_at: Optional[int] = None
     is_active: bool = True
+    # (username, link, prefix) the message link prefix was built from
+    _link_cache: Optional[Tuple[Optional[str], Optional[str], str]] = field(
+        default=None, init=False, repr=False, compare=False
+    )
+
+    def message_link(self, message_id: int) -> str:
+        """
+        Same as build_message_link for this channel, with the per-channel prefix built once.
+        """
+        cached = self._link_cache
+        if cached is None or cached[0] is not self.username or cached[1] is not self.link:
+            prefix = _message_link_prefix(self.chat_id, self.username, self.link)
+            cached = self._link_cache = (self.username, self.link, prefix)
+        return f"{cached[2]}{message_id}"
 
 
-@dataclass
+@dataclass(slots=True)
 class TagRecord:
     id: int
     tag: str
 
 
+def since_days_range(days: int) -> Tuple[int, int]:
+    # Plain epoch arithmetic; avoids building tz-aware datetimes on every poll
+    end_ts = int(time.time())
+    return end_ts - days * 86400, end_ts
+
+
+# id is a plain rowid alias: AUTOINCREMENT would add a sqlite_sequence write per insert
+_MESSAGES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY,
+        message_id INTEGER NOT NULL,
+        chat_id TEXT NOT NULL,
+        author TEXT,
+        full_name TEXT,
+        date_ts INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        views INTEGER,
+        forwards INTEGER,
+        replies INTEGER,
+        UNIQUE(chat_id, message_id)
+    )
+"""
+
+_CACHED_STATEMENTS = 256
+# Bump when _bootstrap_schema changes so existing databases run it again
+_SCHEMA_VERSION = 1
+_FETCH_BATCH = 1000
+
+
+@lru_cache(maxsize=64)
+def _window_sql(by_chat: bool, fts: bool = False, raw_text: bool = False) -> str:
+    """
+    Window query text, built once per shape. Chat ids bind as one JSON array, so the text does
+    not depend on how many there are and the statement cache keeps hitting. With `raw_text`
+    the text column comes back as undecoded UTF-8 bytes.
+    """
+    where = _window_where(by_chat)
+    if fts:
+        where = f"id IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?) AND {where}"
+    return (
+        "SELECT message_id, chat_id, author, full_name, date_ts, "
+        f"{'CAST(text AS BLOB)' if raw_text else 'text'}, views, forwards, replies "
+        f"FROM messages WHERE {where} ORDER BY date_ts ASC"
+    )
+
+
+def _window_where(by_chat: bool) -> str:
+    # Binds start_ts, end_ts and, with by_chat, the JSON array of chat ids
+    if by_chat:
+        return "date_ts BETWEEN ? AND ? AND chat_id IN (SELECT value FROM json_each(?))"
+    return "date_ts BETWEEN ? AND ?"
+
+
+@lru_cache(maxsize=4)
+def _author_stats_sql(by_chat: bool) -> str:
+    return (
+        "SELECT author, full_name, COUNT(*) AS c, COALESCE(SUM(views), 0) "
+        f"FROM messages WHERE {_window_where(by_chat)} "
+        "GROUP BY author, full_name ORDER BY c DESC, MIN(date_ts) ASC LIMIT ?"
+    )
+
+
+@lru_cache(maxsize=4)
+def _histogram_sql(by_chat: bool) -> str:
+    return (
+        "SELECT (date_ts / ?) * ? AS bucket, COUNT(*) "
+        f"FROM messages WHERE {_window_where(by_chat)} GROUP BY bucket ORDER BY bucket ASC"
+    )
+
+
+# The only non-ASCII characters whose str.lower() contains ASCII (U+0130 and the Kelvin sign)
+_ASCII_LOWERING_BYTES = ('\u0130'.encode(), '\u212a'.encode())
+
+
+def _bytes_may_match(raw: bytes, tags: Sequence[bytes]) -> bool:
+    """
+    Cheap superset of any_tag_in for ASCII tags, checked on the undecoded UTF-8 text.
+    """
+    lowered = raw.lower()  # bytes.lower() only folds ASCII, which is all an ASCII tag can match
+    if any(tag in lowered for tag in tags):
+        return True
+    return any(ch in raw for ch in _ASCII_LOWERING_BYTES)
+
+
+# Update in place so the row keeps its id; older copies never overwrite newer ones.
+_UPSERT_MESSAGE_SQL = """
+    INSERT INTO messages
+    (message_id, chat_id, author, full_name, date_ts, text, views, forwards, replies)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id, message_id) DO UPDATE SET
+        author=excluded.author,
+        full_name=excluded.full_name,
+        date_ts=excluded.date_ts,
+        text=excluded.text,
+        views=excluded.views,
+        forwards=excluded.forwards,
+        replies=excluded.replies
+    WHERE excluded.date_ts >= messages.date_ts
+"""
+
+
+_ADD_TAG_SQL = (
+    "INSERT INTO tags (tag) VALUES (?) ON CONFLICT(tag) DO UPDATE SET tag=excluded.tag RETURNING id, tag"
+)
+
+
 class MessageStore:
+    """
+    SQLite-backed store for messages, channels and tags.
+
+    The connections are opened with check_same_thread=False, but transactions are per
+    connection: threads sharing one store must serialize their writes themselves
+    (the collector does so under its write lock).
+    """
+
     def __init__(self, db_path: str):
         self.db_path = Path(db_path)
-        if self.db_path.parent and not self.db_path.parent.exists():
+        self.in_memory = str(db_path) == ':memory:'
+        if not self.in_memory and self.db_path.parent and not self.db_path.parent.exists():
             self.db_path.parent.mkdir(parents=True, exist_ok=True)
-        self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self.conn = sqlite3.connect(
+            ':memory:' if self.in_memory else self.db_path,
+            check_same_thread=False,
+            cached_statements=_CACHED_STATEMENTS,
+        )
         self.conn.row_factory = sqlite3.Row
+        # Channel/tag read caches, cleared by this store's own writes. They assume no other
+        # writer while the store is open, which holds for the short-lived CLI commands.
+        # Callers always get copies, so mutating a returned record cannot change the cache.
+        self._channel_cache: Dict[str, ChannelRecord] = {}
+        self._channel_lists: Dict[bool, List[ChannelRecord]] = {}
+        self._tags_cache: Optional[List[TagRecord]] = None
+        self._configure_connection(self.conn)
         self._ensure_schema()
+        # Reads go through their own read-only connection so they never queue behind writes
+        if self.in_memory:
+            self._read = self.conn
+        else:
+            uri = self.db_path.resolve().as_uri() + '?mode=ro'
+            self._read = sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=_CACHED_STATEMENTS)
+            self._read.row_factory = sqlite3.Row
+            self._configure_connection(self._read)
+
+    def _configure_connection(self, conn: sqlite3.Connection):
+        # WAL lets the collector and the CLI share the file; NORMAL sync is safe under WAL.
+        if not self.in_memory:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA mmap_size=268435456")
+            conn.execute("PRAGMA wal_autocheckpoint=1000")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")  # 64 MiB
+        conn.execute("PRAGMA busy_timeout=5000")
 
     def _ensure_schema(self):
+        # A database already bootstrapped at this version (with its FTS index) needs no DDL
+        version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= _SCHEMA_VERSION and self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+        ).fetchone():
+            self.has_fts = True
+            return
+        self._bootstrap_schema()
+        if version < _SCHEMA_VERSION:
+            self.conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def _bootstrap_schema(self):
         with self.conn:
-            self.conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    message_id INTEGER NOT NULL,
-                    chat_id TEXT NOT NULL,
-                    author TEXT,
-                    full_name TEXT,
-                    date_ts INTEGER NOT NULL,
-                    text TEXT NOT NULL,
-                    views INTEGER,
-                    forwards INTEGER,
-                    replies INTEGER,
-                    UNIQUE(chat_id, message_id)
-                )
-                """
-            )
+            self._migrate_messages_autoincrement()
+            self.conn.execute(_MESSAGES_TABLE_SQL.format(name='messages'))
             self.conn.execute(
                 """
                 CREATE TABLE IF NOT EXISTS channels (
@@ -96,40 +309,198 @@ class MessageStore:
                 )
                 """
             )
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS digest_cache (
+                    key TEXT PRIMARY KEY,
+                    text TEXT NOT NULL,
+                    created_ts INTEGER NOT NULL
+                )
+                """
+            )
             self.conn.execute(
                 "CREATE INDEX IF NOT EXISTS idx_messages_date ON messages(date_ts)"
             )
             self.conn.execute(
-                "CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id)"
+                "CREATE INDEX IF NOT EXISTS idx_messages_chat_date ON messages(chat_id, date_ts)"
             )
+            # Chat-only lookups use the left prefix of idx_messages_chat_date
+            self.conn.execute("DROP INDEX IF EXISTS idx_messages_chat")
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_channels_username ON channels(username)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_channels_link ON channels(link)"
+            )
+        self.has_fts = self._ensure_fts()
 
-    def upsert_message(self, record: MessageRecord):
-        if record.text is None or str(record.text).strip() == '':
+    def _migrate_messages_autoincrement(self):
+        """
+        Rebuild a messages table created with AUTOINCREMENT, keeping every row id.
+        """
+        row = self.conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'messages'"
+        ).fetchone()
+        if not row or 'AUTOINCREMENT' not in row[0].upper():
             return
+        # sqlite3 runs DDL in autocommit by default; open the transaction first so a failed
+        # copy rolls back the new table too
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN")
+        self.conn.execute(_MESSAGES_TABLE_SQL.format(name='messages_new'))
+        self.conn.execute(
+            """
+            INSERT INTO messages_new
+            (id, message_id, chat_id, author, full_name, date_ts, text, views, forwards, replies)
+            SELECT id, message_id, chat_id, author, full_name, date_ts, text, views, forwards, replies
+            FROM messages
+            """
+        )
+        self.conn.execute("DROP TABLE messages")
+        self.conn.execute("ALTER TABLE messages_new RENAME TO messages")
+
+    def _ensure_fts(self) -> bool:
+        """
+        Trigram full-text index over messages.text, kept in sync by triggers.
+
+        Returns False when this SQLite build has no FTS5/trigram support.
+        """
+        existed = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'"
+        ).fetchone()
+        try:
+            with self.conn:
+                self.conn.execute(
+                    """
+                    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts
+                    USING fts5(text, content='messages', content_rowid='id', tokenize='trigram')
+                    """
+                )
+                self.conn.execute(
+                    """
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_ai AFTER INSERT ON messages BEGIN
+                        INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+                    END
+                    """
+                )
+                self.conn.execute(
+                    """
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_ad AFTER DELETE ON messages BEGIN
+                        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                    END
+                    """
+                )
+                self.conn.execute(
+                    """
+                    CREATE TRIGGER IF NOT EXISTS messages_fts_au AFTER UPDATE OF text ON messages BEGIN
+                        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+                        INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+                    END
+                    """
+                )
+                if not existed:
+                    # Index rows stored before the FTS table existed
+                    self.conn.execute("INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')")
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+    def upsert_message(self, record: MessageRecord):
+        self.upsert_messages((record,))
+
+    def upsert_messages(self, records: Iterable[MessageRecord]) -> int:
+        """
+        Upsert many records in one transaction. Returns the number of rows written.
+        """
+        rows = [
+            (
+                record.message_id,
+                record.chat_id,
+                record.author,
+                record.full_name,
+                record.date_ts,
+                record.text,
+                record.views,
+                record.forwards,
+                record.replies,
+            )
+            for record in records
+            if record.text is not None and str(record.text).strip() != ''
+        ]
+        if not rows:
+            return 0
         with self.conn:
-            self.conn.execute(
-                """
-                INSERT OR REPLACE INTO messages
-                (message_id, chat_id, author, full_name, date_ts, text, views, forwards, replies)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    record.message_id,
-                    record.chat_id,
-                    record.author,
-                    record.full_name,
-                    record.date_ts,
-                    record.text,
-                    record.views,
-                    record.forwards,
-                    record.replies,
-                ),
+            cursor = self.conn.executemany(
+                _UPSERT_MESSAGE_SQL,
+                rows,
             )
+        # rowcount counts only the messages rows changed, not the FTS trigger writes
+        return cursor.rowcount
 
     def fetch_since_days(self, days: int, chat_ids: Optional[Sequence[str]] = None) -> List[MessageRecord]:
-        now = datetime.now(tz=timezone.utc)
-        since = now - timedelta(days=days)
-        return self.fetch_between(since, now, chat_ids=chat_ids)
+        start_ts, end_ts = since_days_range(days)
+        return list(self._iter_between_ts(start_ts, end_ts, chat_ids))
+
+    def fetch_top_between_ts(self, start_ts: int, end_ts: int, limit: int) -> List[MessageRecord]:
+        """
+        Highest-scoring messages in the window, scored in SQL like digest_builder._score.
+        """
+        rows = self._execute_tuples(
+            """
+            SELECT message_id, chat_id, author, full_name, date_ts, text, views, forwards, replies
+            FROM messages
+            WHERE date_ts BETWEEN ? AND ?
+            ORDER BY COALESCE(views, 0) * 2 + MIN(length(text) / 120, 5) DESC, date_ts ASC, id ASC
+            LIMIT ?
+            """,
+            (start_ts, end_ts, limit),
+        ).fetchall()
+        return [self._row_to_record(row) for row in rows]
+
+    def stats_between_ts(self, start_ts: int, end_ts: int) -> WindowStats:
+        row = self._read.execute(
+            """
+            SELECT COUNT(*),
+                   COUNT(DISTINCT COALESCE(NULLIF(author, ''), NULLIF(full_name, ''), 'anon')),
+                   MIN(date_ts),
+                   MAX(date_ts)
+            FROM messages
+            WHERE date_ts BETWEEN ? AND ?
+            """,
+            (start_ts, end_ts),
+        ).fetchone()
+        return WindowStats(count=row[0], authors=row[1], first_ts=row[2], last_ts=row[3])
+
+    def author_stats(
+        self,
+        start_ts: int,
+        end_ts: int,
+        chat_ids: Optional[Sequence[str]] = None,
+        limit: int = 10,
+    ) -> List[Tuple[Optional[str], Optional[str], int, int]]:
+        """
+        Most active authors in the window as (author, full_name, messages, total_views).
+        """
+        params = [start_ts, end_ts]
+        if chat_ids:
+            params.append(json.dumps(list(chat_ids)))
+        params.append(limit)
+        return self._execute_tuples(_author_stats_sql(bool(chat_ids)), params).fetchall()
+
+    def activity_histogram(
+        self,
+        start_ts: int,
+        end_ts: int,
+        bucket_seconds: int = 86400,
+        chat_ids: Optional[Sequence[str]] = None,
+    ) -> List[Tuple[int, int]]:
+        """
+        Message counts per `bucket_seconds` slot as (bucket_start_ts, count), oldest first.
+        """
+        params = [bucket_seconds, bucket_seconds, start_ts, end_ts]
+        if chat_ids:
+            params.append(json.dumps(list(chat_ids)))
+        return self._execute_tuples(_histogram_sql(bool(chat_ids)), params).fetchall()
 
     def fetch_between(
         self,
@@ -137,28 +508,100 @@ class MessageStore:
         end: datetime,
         chat_ids: Optional[Sequence[str]] = None,
     ) -> List[MessageRecord]:
-        start_ts = int(start.timestamp())
-        end_ts = int(end.timestamp())
+        return list(self.iter_between(start, end, chat_ids=chat_ids))
+
+    def iter_between(
+        self,
+        start: datetime,
+        end: datetime,
+        chat_ids: Optional[Sequence[str]] = None,
+    ) -> Iterator[MessageRecord]:
+        """
+        Yield records in the window in fetch batches instead of materializing them all.
+        """
+        return self._iter_between_ts(int(start.timestamp()), int(end.timestamp()), chat_ids)
+
+    def _iter_between_ts(
+        self,
+        start_ts: int,
+        end_ts: int,
+        chat_ids: Optional[Sequence[str]] = None,
+    ) -> Iterator[MessageRecord]:
         params = [start_ts, end_ts]
-        channel_clause = ""
         if chat_ids:
-            placeholders = ",".join("?" for _ in chat_ids)
-            channel_clause = f" AND chat_id IN ({placeholders})"
-            params.extend(list(chat_ids))
-        with self.conn:
-            rows = self.conn.execute(
-                """
-                SELECT message_id, chat_id, author, full_name, date_ts, text, views, forwards, replies
-                FROM messages
-                WHERE date_ts BETWEEN ? AND ?
-                """
-                + channel_clause
-                + """
-                ORDER BY date_ts ASC
-                """,
-                params,
-            ).fetchall()
-        return [self._row_to_record(row) for row in rows]
+            params.append(json.dumps(list(chat_ids)))
+        yield from self._iter_records(self._execute_tuples(_window_sql(bool(chat_ids)), params))
+
+    def fetch_matching(
+        self,
+        start: datetime,
+        end: datetime,
+        tags: Sequence[str],
+        chat_ids: Optional[Sequence[str]] = None,
+    ) -> List[MessageRecord]:
+        return list(self.iter_matching(start, end, tags, chat_ids=chat_ids))
+
+    def iter_matching(
+        self,
+        start: datetime,
+        end: datetime,
+        tags: Sequence[str],
+        chat_ids: Optional[Sequence[str]] = None,
+    ) -> Iterator[MessageRecord]:
+        """
+        Messages in the window that may contain any of `tags`, narrowed by the FTS index.
+
+        The result is a superset of the exact matches; callers still check each tag. When the
+        index cannot answer (no FTS5, or a tag shorter than a trigram) ASCII tags are checked
+        on the raw UTF-8 bytes, so only candidate rows are decoded; otherwise this is iter_between.
+        """
+        terms = sorted({t.lower() for t in tags if t})
+        if not terms or not all(t.isascii() for t in terms):
+            yield from self.iter_between(start, end, chat_ids=chat_ids)
+            return
+        if not self.has_fts or any(len(t) < 3 for t in terms):
+            yield from self._iter_prefiltered(start, end, [t.encode() for t in terms], chat_ids)
+            return
+        match_expr = ' OR '.join('"' + t.replace('"', '""') + '"' for t in terms)
+        params = [match_expr, int(start.timestamp()), int(end.timestamp())]
+        if chat_ids:
+            params.append(json.dumps(list(chat_ids)))
+        yield from self._iter_records(self._execute_tuples(_window_sql(bool(chat_ids), fts=True), params))
+
+    def _iter_prefiltered(
+        self,
+        start: datetime,
+        end: datetime,
+        tags: Sequence[bytes],
+        chat_ids: Optional[Sequence[str]] = None,
+    ) -> Iterator[MessageRecord]:
+        params = [int(start.timestamp()), int(end.timestamp())]
+        if chat_ids:
+            params.append(json.dumps(list(chat_ids)))
+        cursor = self._execute_tuples(_window_sql(bool(chat_ids), raw_text=True), params)
+        while True:
+            batch = cursor.fetchmany(_FETCH_BATCH)
+            if not batch:
+                return
+            for row in batch:
+                raw = row[5]
+                if _bytes_may_match(raw, tags):
+                    yield MessageRecord(*row[:5], raw.decode('utf-8'), *row[6:])
+
+    def search_tag(
+        self,
+        tag: str,
+        start: datetime,
+        end: datetime,
+        chat_ids: Optional[Sequence[str]] = None,
+    ) -> List[MessageRecord]:
+        """
+        Messages in the window containing `tag` (case-insensitive), found through the FTS index.
+        """
+        if not tag:
+            return []
+        tags_lower = (tag.lower(),)
+        return [rec for rec in self.iter_matching(start, end, [tag], chat_ids=chat_ids) if any_tag_in(rec, tags_lower)]
 
     def upsert_channel(self, record: ChannelRecord):
         with self.conn:
@@ -177,55 +620,116 @@ class MessageStore:
                     "chat_id": record.chat_id,
                     "title": record.title,
                     "username": record.username,
-                    "link": record.link,
+                    "link": record.link.rstrip("/") if record.link else record.link,
                     "access_hash": record.access_hash,
-                    "added_at": record.added_at or int(datetime.now(tz=timezone.utc).timestamp()),
+                    "added_at": record.added_at or int(time.time()),
                     "is_active": 1 if record.is_active else 0,
                 },
             )
+        self._invalidate_channels()
 
     def remove_channel(self, chat_id: str):
         with self.conn:
             self.conn.execute("DELETE FROM channels WHERE chat_id = ?", (chat_id,))
+        self._invalidate_channels()
+
+    def _invalidate_channels(self):
+        self._channel_cache.clear()
+        self._channel_lists.clear()
 
     def list_channels(self, active_only: bool = False) -> List[ChannelRecord]:
-        clause = "WHERE is_active = 1" if active_only else ""
-        with self.conn:
-            rows = self.conn.execute(
+        cached = self._channel_lists.get(active_only)
+        if cached is None:
+            clause = "WHERE is_active = 1" if active_only else ""
+            rows = self._read.execute(
                 f"SELECT chat_id, title, username, link, access_hash, added_at, is_active FROM channels {clause} ORDER BY added_at DESC"
             ).fetchall()
-        return [self._row_to_channel(row) for row in rows]
+            cached = self._channel_lists[active_only] = [self._row_to_channel(row) for row in rows]
+        return [replace(channel) for channel in cached]
 
     def get_channel(self, chat_id: str) -> Optional[ChannelRecord]:
-        with self.conn:
-            row = self.conn.execute(
-                "SELECT chat_id, title, username, link, access_hash, added_at, is_active FROM channels WHERE chat_id = ?",
-                (chat_id,),
-            ).fetchone()
+        cached = self._channel_cache.get(chat_id)
+        if cached is not None:
+            return replace(cached)
+        row = self._read.execute(
+            "SELECT chat_id, title, username, link, access_hash, added_at, is_active FROM channels WHERE chat_id = ?",
+            (chat_id,),
+        ).fetchone()
+        if not row:
+            return None
+        channel = self._channel_cache[chat_id] = self._row_to_channel(row)
+        return replace(channel)
+
+    def find_channel(self, identifier: str) -> Optional[ChannelRecord]:
+        """
+        Look up a stored channel by chat_id, @username or link.
+        """
+        row = self._read.execute(
+            """
+            SELECT chat_id, title, username, link, access_hash, added_at, is_active FROM channels
+            WHERE chat_id = ? OR username = ? OR link = ?
+            ORDER BY added_at DESC
+            LIMIT 1
+            """,
+            (identifier, identifier.replace('@', ''), identifier),
+        ).fetchone()
         return self._row_to_channel(row) if row else None
 
     def add_tag(self, tag: str) -> TagRecord:
-        tag_norm = tag.strip().lower()
-        if not tag_norm:
+        return self.add_tags((tag,))[0]
+
+    def add_tags(self, tags: Iterable[str]) -> List[TagRecord]:
+        """
+        Insert tags in one transaction, returning a record per input (existing tags included).
+        """
+        tags_norm = [tag.strip().lower() for tag in tags]
+        if not all(tags_norm):
             raise ValueError("Tag cannot be empty")
         with self.conn:
-            self.conn.execute(
-                "INSERT OR IGNORE INTO tags (tag) VALUES (?)",
-                (tag_norm,),
-            )
-            row = self.conn.execute(
-                "SELECT id, tag FROM tags WHERE tag = ?", (tag_norm,)
-            ).fetchone()
-        return self._row_to_tag(row)
+            # executemany() drops RETURNING rows, so run the cached statement per tag
+            rows = [
+                self.conn.execute(_ADD_TAG_SQL, (tag_norm,)).fetchone()
+                for tag_norm in tags_norm
+            ]
+        self._tags_cache = None
+        return [self._row_to_tag(row) for row in rows]
 
     def remove_tag(self, tag: str):
         with self.conn:
             self.conn.execute("DELETE FROM tags WHERE tag = ?", (tag.strip().lower(),))
+        self._tags_cache = None
 
     def list_tags(self) -> List[TagRecord]:
+        if self._tags_cache is None:
+            rows = self._read.execute("SELECT id, tag FROM tags ORDER BY tag ASC").fetchall()
+            self._tags_cache = [self._row_to_tag(row) for row in rows]
+        return [replace(tag) for tag in self._tags_cache]
+
+    def get_cached_digest(self, key: str, max_age: Optional[int] = None) -> Optional[str]:
+        """
+        Stored digest text for a prompt hash, or None. Entries older than `max_age` seconds are dropped.
+        """
+        row = self._read.execute(
+            "SELECT text, created_ts FROM digest_cache WHERE key = ?", (key,)
+        ).fetchone()
+        if not row:
+            return None
+        now_ts = int(time.time())
+        if max_age is not None and row["created_ts"] + max_age < now_ts:
+            with self.conn:
+                self.conn.execute("DELETE FROM digest_cache WHERE key = ?", (key,))
+            return None
+        return row["text"]
+
+    def cache_digest(self, key: str, text: str):
         with self.conn:
-            rows = self.conn.execute("SELECT id, tag FROM tags ORDER BY tag ASC").fetchall()
-        return [self._row_to_tag(row) for row in rows]
+            self.conn.execute(
+                """
+                INSERT INTO digest_cache (key, text, created_ts) VALUES (?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET text=excluded.text, created_ts=excluded.created_ts
+                """,
+                (key, text, int(time.time())),
+            )
 
     def _row_to_channel(self, row: sqlite3.Row) -> ChannelRecord:
         return ChannelRecord(
@@ -241,24 +745,34 @@ class MessageStore:
     def _row_to_tag(self, row: sqlite3.Row) -> TagRecord:
         return TagRecord(id=row["id"], tag=row["tag"])
 
-    def _row_to_record(self, row: sqlite3.Row) -> MessageRecord:
-        return MessageRecord(
-            message_id=row['message_id'],
-            chat_id=row['chat_id'],
-            author=row['author'],
-            full_name=row['full_name'],
-            date_ts=row['date_ts'],
-            text=row['text'],
-            views=row['views'],
-            forwards=row['forwards'],
-            replies=row['replies'],
-        )
+    def _iter_records(self, cursor: sqlite3.Cursor) -> Iterator[MessageRecord]:
+        # fetchmany hands rows over in chunks rather than one C call per row
+        while True:
+            batch = cursor.fetchmany(_FETCH_BATCH)
+            if not batch:
+                return
+            for row in batch:
+                yield self._row_to_record(row)
+
+    def _execute_tuples(self, sql: str, params: Sequence) -> sqlite3.Cursor:
+        """
+        Run a message query on the read connection with plain tuple rows (no sqlite3.Row).
+        """
+        cursor = self._read.cursor()
+        cursor.row_factory = None
+        return cursor.execute(sql, params)
+
+    def _row_to_record(self, row: Sequence) -> MessageRecord:
+        # Message SELECTs list columns in MessageRecord field order
+        return MessageRecord(*row)
 
     def close(self):
-        try:
-            self.conn.close()
-        except Exception:
-            pass
+        conns = (self.conn,) if self._read is self.conn else (self._read, self.conn)
+        for conn in conns:
+            try:
+                conn.close()
+            except Exception:
+                pass
 
 
 def message_from_telegram(msg, chat_id: str) -> Optional[MessageRecord]:
@@ -295,11 +809,13 @@ def build_message_link(chat_id: str, message_id: int, channel_username: Optional
     """
     Build a direct link to a Telegram post. Prefers public username link if available.
     """
+    return f"{_message_link_prefix(chat_id, channel_username, channel_link)}{message_id}"
+
+
+def _message_link_prefix(chat_id: str, channel_username: Optional[str], channel_link: Optional[str]) -> str:
     if channel_link:
-        base = channel_link.rstrip("/")
-        return f"{base}/{message_id}"
+        return f"{channel_link.rstrip('/')}/"
     if channel_username:
-        return f"https://t.me/{channel_username}/{message_id}"
+        return f"https://t.me/{channel_username}/"
     # Fallback to internal channel id link (works for members)
-    trimmed = str(chat_id).removeprefix("-100")
-    return f"https://t.me/c/{trimmed}/{message_id}"
+    return f"https://t.me/c/{str(chat_id).removeprefix('-100')}/"